@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Render ASCII maps of QGIS projects without the curses UI.
+
+QgsProject is a singleton so a process can only render one project at a time. To use
+every core the renders are spread over a pool of processes, each running its own QGIS.
+
+usage:
+    ascii_batch.py --size 120x40 --tiles 4x4 --format ansi --output out/ roads.qgs rivers.qgs
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from qgis.core import QgsRectangle
+from parfait import QGIS, projects
+import ascii_render
+from ascii_render import layer_char, layercolormapping, clear_caches, watch_layers, assign_layer_colors, \
+    visible_layers, generate_layers_ascii
+from ascii_stream import sgr, RESET
+
+FORMATS = {
+    'text': '.txt',
+    'ansi': '.ans',
+    'json': '.json',
+}
+
+# Per process state. Each worker keeps the last project open as jobs are grouped by project.
+app = None
+current = {'path': None, 'project': None}
+
+
+def init_worker(idrender=False, cellaspect=2, supersample=1):
+    global app
+    app = QGIS.init(guienabled=False)
+    ascii_render.id_render_enabled = idrender
+    ascii_render.cell_aspect = cellaspect
+    ascii_render.supersample = supersample
+
+
+def load_project(path):
+    if current['path'] == path:
+        return current['project']
+    if current['project']:
+        current['project'].close()
+    clear_caches()
+    current['project'] = projects.open_project(path)
+    current['path'] = path
+    watch_layers()
+    # Colours are picked for a 256 colour terminal.
+    assign_layer_colors(256)
+    return current['project']
+
+
+def tile_extent(extent, tile):
+    """
+    Return the part of the extent covered by a tile.
+    :param extent: A (xmin, ymin, xmax, ymax) tuple.
+    :param tile: A (col, row, cols, rows) tuple. Row 0 is the top of the extent.
+    """
+    xmin, ymin, xmax, ymax = extent
+    col, row, cols, rows = tile
+    width = (xmax - xmin) / float(cols)
+    height = (ymax - ymin) / float(rows)
+    return (xmin + col * width, ymax - (row + 1) * height,
+            xmin + (col + 1) * width, ymax - row * height)
+
+
+def to_text(grid):
+    return "\n".join(grid.text()) + "\n"
+
+
+def to_ansi(grid):
+    """
+    Return the grid as text with the same ANSI colour escapes ascii_stream sends, which
+    match the curses colour pairs.
+    """
+    lines = []
+    for charrow, colourrow in grid.iterrows():
+        parts = []
+        last = None
+        for char, colour in zip(charrow.tolist(), colourrow.tolist()):
+            if colour != last:
+                parts.append(sgr(colour))
+                last = colour
+            parts.append(chr(char))
+        parts.append(RESET)
+        lines.append("".join(parts))
+    return "\n".join(lines) + "\n"
+
+
+def to_json(grid, path, extent, layers):
+    return json.dumps({
+        'project': path,
+        'extent': list(extent),
+        'size': [grid.shape[1], grid.shape[0]],
+        'rows': grid.text(),
+        'colours': grid.colours.tolist(),
+        'layers': [{'id': layer.id(),
+                    'name': layer.name(),
+                    'char': layer_char(layer),
+                    'colour': layercolormapping.get(layer.id(), 0)} for layer in layers],
+    })
+
+
+def render_job(job):
+    """
+    Render one job in a worker process and write it to disk.
+    :return: A (outpath, milliseconds, error) tuple.
+    """
+    path, extent, tile, cols, rows, fmt, outpath = job
+    start = time.time()
+    try:
+        project = load_project(path)
+        settings = project.map_settings
+        if extent is None:
+            canvasextent = settings.extent()
+            extent = (canvasextent.xMinimum(), canvasextent.yMinimum(),
+                      canvasextent.xMaximum(), canvasextent.yMaximum())
+        if tile is not None:
+            extent = tile_extent(extent, tile)
+        settings.setExtent(QgsRectangle(*extent))
+
+        layers = visible_layers()
+        grid = generate_layers_ascii(settings, cols, rows, layers)
+        if fmt == 'json':
+            output = to_json(grid, path, extent, layers)
+        elif fmt == 'ansi':
+            output = to_ansi(grid)
+        else:
+            output = to_text(grid)
+        with open(outpath, "w") as f:
+            f.write(output)
+    except Exception as ex:
+        return outpath, (time.time() - start) * 1000.0, str(ex)
+    return outpath, (time.time() - start) * 1000.0, None
+
+
+def parse_pair(value, cast=int):
+    try:
+        first, second = value.lower().split("x")
+        return cast(first), cast(second)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected a value like 80x24 not {}".format(value))
+
+
+def parse_extent(value):
+    try:
+        values = tuple(float(part) for part in value.split(","))
+    except ValueError:
+        values = ()
+    if len(values) != 4:
+        raise argparse.ArgumentTypeError("Expected xmin,ymin,xmax,ymax not {}".format(value))
+    return values
+
+
+def build_jobs(args):
+    """
+    Return a job for every combination of project, extent, tile and size.
+    """
+    jobs = []
+    extents = args.extent or [None]
+    tiles = [None]
+    if args.tiles:
+        tilecols, tilerows = args.tiles
+        tiles = [(col, row, tilecols, tilerows) for row in range(tilerows) for col in range(tilecols)]
+    sizes = args.size or [(80, 24)]
+    for path in args.projects:
+        path = os.path.abspath(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        for extentindex, extent in enumerate(extents):
+            for tile in tiles:
+                for cols, rows in sizes:
+                    parts = [name]
+                    if args.extent:
+                        parts.append("e{}".format(extentindex))
+                    if tile:
+                        parts.append("t{}_{}".format(tile[0], tile[1]))
+                    parts.append("{}x{}".format(cols, rows))
+                    outpath = os.path.join(args.output, "-".join(parts) + FORMATS[args.format])
+                    jobs.append((path, extent, tile, cols, rows, args.format, outpath))
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render ASCII maps of QGIS projects to disk.")
+    parser.add_argument("projects", nargs="+", help="The .qgs projects to render.")
+    parser.add_argument("--extent", type=parse_extent, action="append",
+                        help="xmin,ymin,xmax,ymax to render. Can be repeated. Defaults to the project extent.")
+    parser.add_argument("--tiles", type=parse_pair, help="Split each extent into a COLSxROWS grid of tiles.")
+    parser.add_argument("--size", type=parse_pair, action="append",
+                        help="COLSxROWS of the output. Can be repeated. Defaults to 80x24.")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="text")
+    parser.add_argument("--output", default=".", help="Folder to write the renders to.")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes. Defaults to the number of cores.")
+    parser.add_argument("--idrender", action="store_true", help="Render all layers in one job into an ID buffer.")
+    parser.add_argument("--cellaspect", type=int, default=2,
+                        help="How many times taller than wide a cell is. Defaults to 2.")
+    parser.add_argument("--supersample", type=int, default=1,
+                        help="Pixels rendered across each cell. Defaults to 1.")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    jobs = build_jobs(args)
+    # Jobs are grouped by project so hand them out in chunks to cut down on project switches.
+    chunksize = max(1, len(jobs) // (args.processes * 4))
+    pool = multiprocessing.Pool(args.processes, initializer=init_worker, initargs=(args.idrender, args.cellaspect, args.supersample))
+    failed = 0
+    start = time.time()
+    try:
+        for count, (outpath, ms, error) in enumerate(pool.imap_unordered(render_job, jobs, chunksize), start=1):
+            if error:
+                failed += 1
+                sys.stderr.write("{}/{} {} failed: {}\n".format(count, len(jobs), outpath, error))
+            else:
+                sys.stdout.write("{}/{} {} ({:0.0f} ms)\n".format(count, len(jobs), outpath, ms))
+    finally:
+        pool.close()
+        pool.join()
+    sys.stdout.write("Rendered {} of {} in {:0.1f} s\n".format(len(jobs) - failed, len(jobs), time.time() - start))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,378 @@
+"""
+The thin client side of ascii_daemon.
+
+When ascii_qgis runs with --connect this module stands in for ascii_render, ascii_pyramid
+and parfait.projects, and its classes stand in for the few QGIS classes the UI uses.
+Renders are sent to the server and the layer tree comes back as plain nodes so the client
+never loads QGIS.
+"""
+import socket
+import threading
+from ascii_daemon import send_message, recv_message, DaemonError
+from ascii_worker import RenderWorker
+from ascii_grid import CellGrid
+
+ENGINES = ("image", "direct")
+
+# Sent with every render so the server draws the grid the way this client is set up.
+engine = "image"
+id_render_enabled = False
+cell_aspect = 2
+supersample = 1
+ncolors = 256
+
+layercolormapping = {}
+
+# The connection to the server, see connect.
+connection = None
+# The open RemoteProject.
+current = None
+
+
+class Connection(object):
+    """
+    A connection to the render server. Requests can come from the UI and the render worker
+    so only one request is in flight at a time.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.lock = threading.Lock()
+
+    def request(self, header):
+        """
+        Send a request and wait for the reply.
+        :return: A (header, payload) tuple.
+        """
+        with self.lock:
+            send_message(self.sock, header)
+            reply, payload = recv_message(self.sock)
+        if 'error' in reply:
+            raise DaemonError(reply['error'])
+        return reply, payload
+
+
+def connect(path):
+    global connection
+    connection = Connection(path)
+    connection.request({'op': 'ping'})
+    return connection
+
+
+class Size(object):
+    def __init__(self, width, height):
+        self._width = width
+        self._height = height
+
+    def width(self):
+        return self._width
+
+    def height(self):
+        return self._height
+
+
+class Point(object):
+    def __init__(self, x, y):
+        self._x = x
+        self._y = y
+
+    def x(self):
+        return self._x
+
+    def y(self):
+        return self._y
+
+
+class Rectangle(object):
+    """
+    The parts of QgsRectangle the map window uses.
+    """
+    def __init__(self, xmin, ymin, xmax, ymax):
+        self.bounds = (float(xmin), float(ymin), float(xmax), float(ymax))
+
+    def xMinimum(self):
+        return self.bounds[0]
+
+    def yMinimum(self):
+        return self.bounds[1]
+
+    def xMaximum(self):
+        return self.bounds[2]
+
+    def yMaximum(self):
+        return self.bounds[3]
+
+    def width(self):
+        return self.bounds[2] - self.bounds[0]
+
+    def height(self):
+        return self.bounds[3] - self.bounds[1]
+
+    def center(self):
+        return Point((self.bounds[0] + self.bounds[2]) / 2.0, (self.bounds[1] + self.bounds[3]) / 2.0)
+
+    def scale(self, factor, center=None):
+        if center is None:
+            center = self.center()
+        width, height = self.width() * factor, self.height() * factor
+        self.bounds = (center.x() - width / 2.0, center.y() - height / 2.0,
+                       center.x() + width / 2.0, center.y() + height / 2.0)
+
+
+class ViewSettings(object):
+    """
+    The parts of QgsMapSettings the map window uses. Only the extent is sent to the server,
+    it renders with the settings from the project.
+    """
+    def __init__(self, other=None, extent=None):
+        self._extent = extent
+        self._size = Size(0, 0)
+        if other is not None:
+            self._extent = Rectangle(*other.extent().bounds)
+            self._size = other._size
+
+    def extent(self):
+        return Rectangle(*self._extent.bounds)
+
+    def setExtent(self, extent):
+        self._extent = Rectangle(*extent.bounds)
+
+    def setOutputSize(self, size):
+        self._size = size
+
+    def mapUnitsPerPixel(self):
+        # The same as QgsMapSettings, the extent grows to fit the output.
+        return max(self._extent.width() / float(self._size.width()),
+                   self._extent.height() / float(self._size.height()))
+
+
+class CheckState(object):
+    """
+    Stands in for Qt when setting legend node visibility.
+    """
+    Unchecked = 0
+    Checked = 2
+
+
+class RemoteVersion(object):
+    QGIS_VERSION = "the one ascii_daemon is running"
+
+
+class RemoteLayer(object):
+    """
+    A layer node of the layer tree from the server. Duck types QgsLayerTreeLayer.
+    """
+    def __init__(self, data):
+        self.id = data['id']
+        self.name = data['name']
+        self.visible = data['visible']
+        self.char = data['char']
+        self.colour = data['colour']
+
+    def __str__(self):
+        return self.name
+
+    def layerId(self):
+        return self.id
+
+    def layerName(self):
+        return self.name
+
+    def layer(self):
+        return self
+
+    def isVisible(self):
+        return self.visible
+
+    def setVisible(self, state):
+        self.visible = state != CheckState.Unchecked
+
+    def isExpanded(self):
+        return False
+
+    def setExpanded(self, expanded):
+        pass
+
+    def children(self):
+        return []
+
+
+class RemoteGroup(object):
+    """
+    A group node of the layer tree from the server. Duck types QgsLayerTreeGroup.
+    """
+    def __init__(self, data):
+        self._name = data['name']
+        self.visible = data['visible']
+        self.expanded = data.get('expanded', True)
+        self._children = [build_node(child) for child in data['children']]
+
+    def __str__(self):
+        return self._name
+
+    def name(self):
+        return self._name
+
+    def isVisible(self):
+        return self.visible
+
+    def setVisible(self, state):
+        self.visible = state != CheckState.Unchecked
+        for child in self._children:
+            child.setVisible(state)
+
+    def isExpanded(self):
+        return self.expanded
+
+    def setExpanded(self, expanded):
+        self.expanded = expanded
+
+    def children(self):
+        return self._children
+
+    def findLayers(self):
+        """
+        Return the layer nodes under the group, top layer first.
+        """
+        layers = []
+        for child in self._children:
+            if isinstance(child, RemoteLayer):
+                layers.append(child)
+            else:
+                layers.extend(child.findLayers())
+        return layers
+
+
+def build_node(data):
+    if data['type'] == 'layer':
+        return RemoteLayer(data)
+    return RemoteGroup(data)
+
+
+class RemoteProject(object):
+    """
+    A project open on the server. Duck types parfait's Project and QgsProject.instance().
+    """
+    def __init__(self, path):
+        self.path = path
+        self.root = None
+        self.bounds = None
+        self.refresh()
+
+    @staticmethod
+    def instance():
+        # QgsProject always has a layer tree, even before a project is opened.
+        return current or EMPTY_PROJECT
+
+    def refresh(self):
+        """
+        Fetch the layer tree and default extent again. Visibility set on this client is kept.
+        """
+        reply, _ = connection.request({'op': 'tree', 'project': self.path, 'ncolors': ncolors})
+        old = dict((layer.id, layer.visible) for layer in self.root.findLayers()) if self.root else {}
+        self.root = build_node(reply['tree'])
+        self.bounds = reply['extent']
+        layercolormapping.clear()
+        for layer in self.root.findLayers():
+            layer.visible = old.get(layer.id, layer.visible)
+            layercolormapping[layer.id] = layer.colour
+
+    @property
+    def map_settings(self):
+        return ViewSettings(extent=Rectangle(*self.bounds))
+
+    def layerTreeRoot(self):
+        return self.root
+
+    def close(self):
+        pass
+
+
+class EmptyProject(object):
+    def __init__(self):
+        self.root = RemoteGroup({'name': '', 'visible': True, 'children': []})
+
+    def layerTreeRoot(self):
+        return self.root
+
+
+EMPTY_PROJECT = EmptyProject()
+
+
+def open_project(path):
+    global current
+    current = RemoteProject(path)
+    return current
+
+
+def assign_layer_colors(colors):
+    global ncolors
+    ncolors = colors
+    if current:
+        current.refresh()
+
+
+def clear_caches():
+    # The caches live on the server and are shared with every other client.
+    pass
+
+
+def watch_layers():
+    pass
+
+
+def layer_char(layer):
+    return layer.char
+
+
+def cell_pixels():
+    return supersample, cell_aspect * supersample
+
+
+def output_size(cols, rows):
+    xpixels, ypixels = cell_pixels()
+    return Size(cols * xpixels, rows * ypixels)
+
+
+def visible_layers():
+    """
+    Return the visible layer nodes, bottom layer first.
+    """
+    if not current:
+        return []
+    return [layer for layer in reversed(current.root.findLayers()) if layer.isVisible()]
+
+
+def render_view(settings, cols, rows, layers, pan=None):
+    """
+    Ask the server to render the view. Takes the same arguments as ascii_render.render_view.
+    :return: A CellGrid.
+    """
+    header = {
+        'op': 'render',
+        'project': current.path,
+        'ncolors': ncolors,
+        'extent': list(settings.extent().bounds),
+        'cols': cols,
+        'rows': rows,
+        'layers': [layer.layerId() for layer in layers],
+        'cellaspect': cell_aspect,
+        'supersample': supersample,
+        'idrender': id_render_enabled,
+        'engine': engine,
+    }
+    if pan:
+        oldsettings, dx, dy = pan
+        header['pan'] = [list(oldsettings.extent().bounds), dx, dy]
+    reply, payload = connection.request(header)
+    return CellGrid.frombytes(reply['rows'], reply['cols'], payload)
+
+
+def schedule(worker, settings):
+    # Zoom previews aren't sent over the socket, the server cache makes renders quick enough.
+    pass
+
+
+def preview(settings, cols, rows, layers):
+    return None
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+"""
+A long running render server shared by many ascii_qgis sessions.
+
+The server keeps QGIS, the project and the render caches warm and answers requests from
+thin clients, see ascii_client, over a local Unix socket. The second session on a project
+doesn't pay for QGIS starting, the project loading or a cold cache.
+
+Every message is a frame of two big endian uint32 lengths, a JSON header and a binary
+payload. Render replies carry the grid as rows * cols char codes followed by rows * cols
+little endian uint16 colour pairs, see CellGrid.tobytes.
+
+Anyone who can connect can make the server open any project it can read, so the socket
+is only open to the user running the server. By default it lives in a directory only
+they can get into, see default_socket.
+
+usage:
+    ascii_daemon.py
+    ascii_qgis.py --connect
+"""
+import os
+import sys
+import json
+import stat
+import time
+import socket
+import select
+import struct
+import logging
+import argparse
+import tempfile
+
+FRAME = struct.Struct("!II")
+# Seconds a client has to send the rest of a request once it has started one. A client
+# that stalls part way through would otherwise hold up every other client.
+REQUEST_TIMEOUT = 2.0
+
+
+class DaemonError(Exception):
+    """
+    Raised on the client when the server couldn't answer a request, and by the server
+    when it can't listen on its socket.
+    """
+    pass
+
+
+def default_socket():
+    """
+    Return the path of the socket for this user, in $XDG_RUNTIME_DIR or else a folder
+    of their own in the temp folder.
+    """
+    folder = os.environ.get("XDG_RUNTIME_DIR")
+    if not folder:
+        folder = os.path.join(tempfile.gettempdir(), "ascii_qgis-{}".format(os.getuid()))
+    return os.path.join(folder, "ascii_qgis.sock")
+
+
+def private_folder(folder):
+    """
+    Make the folder only the current user can get into, if it doesn't exist, and check
+    nobody else owns or can get into it if it does.
+    """
+    if not os.path.lexists(folder):
+        os.makedirs(folder, 0o700)
+    info = os.lstat(folder)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise DaemonError("{} has to be a folder only you can get into".format(folder))
+
+
+def clear_stale_socket(path):
+    """
+    Remove the socket a server that died left behind. Nothing is removed if a server is
+    still listening on it or it isn't a socket.
+    """
+    if not os.path.lexists(path):
+        return
+    if not stat.S_ISSOCK(os.lstat(path).st_mode):
+        raise DaemonError("{} already exists and isn't a socket".format(path))
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise DaemonError("A server is already listening on {}".format(path))
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock, header, payload=b""):
+    data = json.dumps(header).encode("utf-8")
+    sock.sendall(FRAME.pack(len(data), len(payload)) + data + payload)
+
+
+def recv_message(sock):
+    """
+    Read one message from the socket.
+    :return: A (header, payload) tuple.
+    """
+    headersize, payloadsize = FRAME.unpack(_recv_exactly(sock, FRAME.size))
+    header = json.loads(_recv_exactly(sock, headersize).decode("utf-8"))
+    payload = _recv_exactly(sock, payloadsize) if payloadsize else b""
+    return header, payload
+
+
+class RenderServer(object):
+    """
+    Serves renders of projects to clients connected on a Unix socket.
+
+    QgsProject is a single project so requests are answered one at a time on the main
+    thread. Switching project keeps the render caches, cached grids are keyed by layer id
+    so going back to a project is still warm. Caches are only dropped when a project file
+    changes on disk.
+    """
+    def __init__(self, path):
+        import ascii_render
+        from parfait import projects
+        self.render = ascii_render
+        self.projects = projects
+        self.path = path
+        self.project = None
+        self.projectpath = None
+        self.stamps = {}
+        self.ncolors = None
+        self.listener = None
+        self.clients = []
+
+    def load(self, path):
+        """
+        Make the project at path the current project, if it isn't already.
+        """
+        stamp = os.stat(path).st_mtime
+        if path == self.projectpath and self.stamps.get(path) == stamp:
+            return self.project
+        if self.stamps.get(path, stamp) != stamp:
+            logging.info("{} changed on disk, clearing caches".format(path))
+            self.render.clear_caches()
+        if self.project:
+            self.project.close()
+        self.project = self.projects.open_project(path)
+        self.projectpath = path
+        self.stamps[path] = stamp
+        self.ncolors = None
+        self.render.watch_layers()
+        return self.project
+
+    def set_colors(self, ncolors):
+        if ncolors != self.ncolors:
+            self.render.assign_layer_colors(ncolors)
+            self.ncolors = ncolors
+
+    def tree(self, node):
+        """
+        Return the layer tree under node as dicts the client builds its legend from.
+        """
+        from qgis.core import QgsLayerTreeLayer
+        if isinstance(node, QgsLayerTreeLayer):
+            return {
+                'type': 'layer',
+                'id': node.layerId(),
+                'name': node.layerName(),
+                'visible': node.isVisible(),
+                'char': self.render.layer_char(node.layer()),
+                'colour': self.render.layercolormapping.get(node.layerId(), 0),
+            }
+        return {
+            'type': 'group',
+            'name': node.name(),
+            'visible': node.isVisible(),
+            'expanded': node.isExpanded(),
+            'children': [self.tree(child) for child in node.children()],
+        }
+
+    def handle(self, header):
+        """
+        Answer a request.
+        :return: A (header, payload) tuple to reply with.
+        """
+        from qgis.core import QgsProject, QgsMapSettings, QgsMapLayerRegistry, QgsRectangle
+
+        op = header.get('op')
+        if op == 'ping':
+            return {'ok': True}, b""
+
+        project = self.load(header['project'])
+        self.set_colors(header.get('ncolors', 256))
+        if op == 'tree':
+            extent = project.map_settings.extent()
+            return {
+                'tree': self.tree(QgsProject.instance().layerTreeRoot()),
+                'extent': [extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum()],
+            }, b""
+
+        if op == 'render':
+            render = self.render
+            render.cell_aspect = header.get('cellaspect', 2)
+            render.supersample = header.get('supersample', 1)
+            render.id_render_enabled = header.get('idrender', False)
+            render.engine = header.get('engine', 'image')
+
+            settings = QgsMapSettings(project.map_settings)
+            settings.setExtent(QgsRectangle(*header['extent']))
+            registry = QgsMapLayerRegistry.instance()
+            layers = [registry.mapLayer(layerid) for layerid in header['layers']]
+            layers = [layer for layer in layers if layer is not None]
+            pan = header.get('pan')
+            if pan:
+                oldextent, dx, dy = pan
+                oldsettings = QgsMapSettings(project.map_settings)
+                oldsettings.setExtent(QgsRectangle(*oldextent))
+                pan = (oldsettings, dx, dy)
+            rows, cols = header['rows'], header['cols']
+            grid = render.render_view(settings, cols, rows, layers, pan)
+            return {'rows': rows, 'cols': cols}, grid.tobytes()
+
+        raise ValueError("Unknown request {}".format(op))
+
+    def serve_once(self, sock):
+        try:
+            header, _ = recv_message(sock)
+        except (EOFError, socket.error):
+            self.clients.remove(sock)
+            sock.close()
+            return
+
+        start = time.time()
+        try:
+            reply, payload = self.handle(header)
+        except Exception as ex:
+            logging.exception("Request {} failed".format(header.get('op')))
+            reply, payload = {'error': str(ex)}, b""
+        logging.info("{} took {:0.1f} ms".format(header.get('op'), (time.time() - start) * 1000.0))
+        try:
+            send_message(sock, reply, payload)
+        except socket.error:
+            self.clients.remove(sock)
+            sock.close()
+
+    def serve_forever(self):
+        clear_stale_socket(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only this user can connect. The umask covers the moment between bind and chmod.
+        umask = os.umask(0o177)
+        try:
+            self.listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, 0o600)
+        self.listener.listen(16)
+        logging.info("Listening on {}".format(self.path))
+        try:
+            while True:
+                readable, _, _ = select.select([self.listener] + self.clients, [], [])
+                for sock in readable:
+                    if sock is self.listener:
+                        client, _ = self.listener.accept()
+                        client.settimeout(REQUEST_TIMEOUT)
+                        self.clients.append(client)
+                    else:
+                        self.serve_once(sock)
+        finally:
+            self.listener.close()
+            os.unlink(self.path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve ASCII renders of QGIS projects to ascii_qgis clients.")
+    parser.add_argument("--socket", help="Unix socket to listen on. Defaults to one in a folder of your own, "
+                                         "see default_socket.")
+    parser.add_argument("--cachesize", type=int, default=256, help="Render cache size in MB. Defaults to 256.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(filename='render_daemon.log', level=logging.INFO)
+    path = args.socket
+    if not path:
+        path = default_socket()
+        try:
+            private_folder(os.path.dirname(path))
+        except DaemonError as ex:
+            sys.stderr.write("{}\n".format(ex))
+            return 1
+    from parfait import QGIS
+    app = QGIS.init(guienabled=False)
+    server = RenderServer(path)
+    server.render.rendercache.resize(args.cachesize * 1024 * 1024)
+    status = 0
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except DaemonError as ex:
+        sys.stderr.write("{}\n".format(ex))
+        status = 1
+    app.exitQgis()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
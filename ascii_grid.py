@@ -0,0 +1,107 @@
+"""
+The grid of terminal cells the render pipeline produces and the UI draws.
+
+A grid is two planes the size of the map: uint8 char codes and uint16 colour pairs.
+Whole frames are worked on with numpy so drawing a frame doesn't make a Python object
+per cell.
+"""
+import numpy
+
+BLANK = ord(' ')
+
+
+def shift_grid(grid, cols, rows, fill):
+    """
+    Return a copy of the grid with its contents moved by the given number of columns and rows.
+    Cells moved in from outside the grid are set to the fill value.
+    """
+    height, width = grid.shape[:2]
+    shifted = numpy.empty_like(grid)
+    shifted[...] = fill
+    if abs(cols) >= width or abs(rows) >= height:
+        return shifted
+    shifted[max(rows, 0):height + min(rows, 0), max(cols, 0):width + min(cols, 0)] = \
+        grid[max(-rows, 0):height - max(rows, 0), max(-cols, 0):width - max(cols, 0)]
+    return shifted
+
+
+class CellGrid(object):
+    """
+    A rows by cols grid of cells, each a char code and a colour pair.
+
+    Indexing with slices returns a grid viewing the same planes, like numpy.
+    """
+    __slots__ = ("chars", "colours")
+
+    def __init__(self, chars, colours):
+        """
+        :param chars: (rows, cols) array of char codes.
+        :param colours: (rows, cols) array of colour pairs.
+        """
+        self.chars = numpy.asarray(chars, dtype=numpy.uint8)
+        self.colours = numpy.asarray(colours, dtype=numpy.uint16)
+
+    @classmethod
+    def frombytes(cls, rows, cols, data):
+        """
+        Read a grid written by tobytes.
+        """
+        cells = rows * cols
+        chars = numpy.frombuffer(data, dtype=numpy.uint8, count=cells).reshape(rows, cols)
+        colours = numpy.frombuffer(data, dtype="<u2", count=cells, offset=cells).reshape(rows, cols)
+        return cls(chars, colours.astype(numpy.uint16))
+
+    def tobytes(self):
+        """
+        Return the char codes followed by the colour pairs as little endian uint16.
+        """
+        return self.chars.tobytes() + self.colours.astype("<u2").tobytes()
+
+    @property
+    def shape(self):
+        return self.chars.shape
+
+    @property
+    def nbytes(self):
+        return self.chars.nbytes + self.colours.nbytes
+
+    def __getitem__(self, index):
+        return CellGrid(self.chars[index], self.colours[index])
+
+    def __setitem__(self, index, grid):
+        self.chars[index] = grid.chars
+        self.colours[index] = grid.colours
+
+    def copy(self):
+        return CellGrid(self.chars.copy(), self.colours.copy())
+
+    def composite(self, other, mask=None):
+        """
+        Draw the cells of other over this grid, where mask is True or else where other isn't blank.
+        """
+        if mask is None:
+            mask = other.chars != BLANK
+        self.chars[mask] = other.chars[mask]
+        self.colours[mask] = other.colours[mask]
+        return self
+
+    def changed(self, other):
+        """
+        Return a bool array of the cells that differ from the other grid. Every cell has
+        changed if there is no other grid or it is a different size.
+        """
+        if other is None or other.shape != self.shape:
+            return numpy.ones(self.shape, dtype=bool)
+        return (self.chars != other.chars) | (self.colours != other.colours)
+
+    def iterrows(self):
+        """
+        Yield the char codes and colour pairs of each row.
+        """
+        return zip(self.chars, self.colours)
+
+    def text(self):
+        """
+        Return each row of chars as a string.
+        """
+        return [row.tobytes().decode("ascii") for row in self.chars]
@@ -0,0 +1,248 @@
+"""
+A stand in for curses so the UI can run without a terminal.
+
+The fake windows keep what is drawn on them in memory and count the calls made so
+benchmarks can run the real drawing code and see what it would have sent.
+
+usage:
+    import ascii_qgis, ascii_headless
+    screen = ascii_headless.install(ascii_qgis, lines=50, cols=200)
+"""
+import curses
+from collections import deque
+
+
+class FakeWindow(object):
+    """
+    Enough of a curses window for the UI and curses.textpad.Textbox.
+    """
+    def __init__(self, nlines, ncols, begin_y=0, begin_x=0):
+        self.nlines = int(nlines)
+        self.ncols = int(ncols)
+        self.begin_y = int(begin_y)
+        self.begin_x = int(begin_x)
+        self.cury = 0
+        self.curx = 0
+        self.keys = deque()
+        self.delay = True
+        self.addstr_calls = 0
+        self.chars_written = 0
+        self.refreshes = 0
+        self.erase()
+
+    def _args(self, args):
+        """
+        Split curses style (y, x, value, attr) / (value, attr) arguments.
+        """
+        if len(args) >= 3 and isinstance(args[0], int) and isinstance(args[1], int):
+            y, x, args = args[0], args[1], args[2:]
+            self.move(y, x)
+        value = args[0]
+        attr = args[1] if len(args) > 1 else 0
+        return value, attr
+
+    def _put(self, char, attr):
+        if self.cury >= self.nlines:
+            raise curses.error("addwstr() returned ERR")
+        self.cells[self.cury][self.curx] = (char, attr)
+        self.chars_written += 1
+        self.curx += 1
+        if self.curx >= self.ncols:
+            self.curx = 0
+            self.cury += 1
+
+    def addstr(self, *args):
+        text, attr = self._args(args)
+        self.addstr_calls += 1
+        for char in text:
+            self._put(char, attr)
+
+    def addch(self, *args):
+        char, attr = self._args(args)
+        if isinstance(char, int):
+            char = chr(char)
+        self._put(char, attr)
+
+    def insch(self, *args):
+        char, attr = self._args(args)
+        if isinstance(char, int):
+            char = chr(char)
+        row = self.cells[self.cury]
+        row.insert(self.curx, (char, attr))
+        row.pop()
+
+    def delch(self, *args):
+        if args:
+            self.move(*args)
+        row = self.cells[self.cury]
+        row.pop(self.curx)
+        row.append((' ', 0))
+
+    def inch(self, *args):
+        if args:
+            self.move(*args)
+        char, attr = self.cells[self.cury][self.curx]
+        return ord(char) | attr
+
+    def clrtoeol(self):
+        row = self.cells[self.cury]
+        for x in range(self.curx, self.ncols):
+            row[x] = (' ', 0)
+
+    def deleteln(self):
+        self.cells.pop(self.cury)
+        self.cells.append([(' ', 0)] * self.ncols)
+
+    def insertln(self):
+        self.cells.insert(self.cury, [(' ', 0)] * self.ncols)
+        self.cells.pop()
+
+    def erase(self):
+        self.cells = [[(' ', 0)] * self.ncols for _ in range(self.nlines)]
+
+    clear = erase
+
+    def box(self, *args):
+        for x in range(self.ncols):
+            self.cells[0][x] = ('-', 0)
+            self.cells[-1][x] = ('-', 0)
+        for y in range(self.nlines):
+            self.cells[y][0] = ('|', 0)
+            self.cells[y][-1] = ('|', 0)
+
+    def move(self, y, x):
+        if not (0 <= y < self.nlines and 0 <= x < self.ncols):
+            raise curses.error("wmove() returned ERR")
+        self.cury, self.curx = y, x
+
+    def getyx(self):
+        return self.cury, self.curx
+
+    def getmaxyx(self):
+        return self.nlines, self.ncols
+
+    def getbegyx(self):
+        return self.begin_y, self.begin_x
+
+    def getch(self):
+        if self.keys:
+            return self.keys.popleft()
+        return -1
+
+    def nodelay(self, flag):
+        self.delay = not flag
+
+    def refresh(self):
+        self.refreshes += 1
+
+    def noutrefresh(self):
+        self.refreshes += 1
+
+    def keypad(self, flag):
+        pass
+
+    def leaveok(self, flag):
+        pass
+
+    def timeout(self, delay):
+        pass
+
+    def touchwin(self):
+        pass
+
+    def bkgd(self, *args):
+        pass
+
+    def text(self):
+        """
+        Return what is drawn on the window as a list of strings.
+        """
+        return ["".join(char for char, _ in row) for row in self.cells]
+
+
+class FakePanel(object):
+    def __init__(self, window):
+        self.window = window
+        self.visible = True
+
+    def show(self):
+        self.visible = True
+
+    def hide(self):
+        self.visible = False
+
+
+class FakePanelModule(object):
+    def new_panel(self, window):
+        return FakePanel(window)
+
+    def update_panels(self):
+        pass
+
+
+class FakeCurses(object):
+    """
+    Stands in for the curses module. Constants come from the real module and anything
+    that needs a terminal is faked.
+    """
+    COLORS = 256
+    COLOR_PAIRS = 256
+
+    def __init__(self, screen):
+        self.screen = screen
+        self.panel = FakePanelModule()
+
+    def __getattr__(self, name):
+        return getattr(curses, name)
+
+    def newwin(self, nlines, ncols, begin_y=0, begin_x=0):
+        window = FakeWindow(nlines, ncols, begin_y, begin_x)
+        self.screen.windows.append(window)
+        return window
+
+    def color_pair(self, number):
+        return number << 8
+
+    def curs_set(self, visibility):
+        return 1
+
+    def doupdate(self):
+        pass
+
+    def endwin(self):
+        pass
+
+    def init_pair(self, pair, fg, bg):
+        pass
+
+    def use_default_colors(self):
+        pass
+
+    def can_change_color(self):
+        return False
+
+
+class FakeScreen(FakeWindow):
+    """
+    The whole terminal. Holds every window made through the fake curses.
+    """
+    def __init__(self, lines, cols):
+        super(FakeScreen, self).__init__(lines, cols)
+        self.windows = []
+
+    def addstr_calls_total(self):
+        return self.addstr_calls + sum(window.addstr_calls for window in self.windows)
+
+
+def install(module, lines=50, cols=200):
+    """
+    Swap the curses module used by module for a fake one drawing to a fake screen.
+    :param module: The module using curses. Normally ascii_qgis.
+    :param lines: The height of the fake terminal.
+    :param cols: The width of the fake terminal.
+    :return: The FakeScreen. It is also set as module.scr.
+    """
+    screen = FakeScreen(lines, cols)
+    module.curses = FakeCurses(screen)
+    module.scr = screen
+    return screen
@@ -0,0 +1,94 @@
+"""
+The layer tree flattened into the rows the legend window shows.
+
+The tree is walked once when a project is loaded. Expanding or collapsing a group only
+inserts or removes the rows under it and checking a node changes no rows at all, the check
+box is read from the node when its row is drawn. The legend only draws the rows that fit
+in the window so a project with thousands of layers costs the same to move around as one
+with five.
+"""
+
+
+class LegendRow(object):
+    """
+    A node of the layer tree shown on one row of the legend.
+    """
+    __slots__ = ("node", "depth", "islayer", "label")
+
+    def __init__(self, node, depth, islayer):
+        self.node = node
+        self.depth = depth
+        self.islayer = islayer
+        if islayer:
+            self.label = "(L) " + node.layerName()
+        else:
+            self.label = "(G) " + node.name()
+
+
+class LegendModel(object):
+    """
+    The rows of the expanded part of a layer tree, in the order they are shown.
+    """
+    def __init__(self, root, layertype):
+        """
+        :param root: The root node of the layer tree.
+        :param layertype: The class of layer nodes, anything else is a group.
+        """
+        self.root = root
+        self.layertype = layertype
+        # Set when nodes are added to or removed from the tree, the rows need building again.
+        self.dirty = False
+        self.rows = self.flatten(root.children(), 0)
+        # QGIS layer trees pass on the signals of their children. The thin client's tree
+        # doesn't change under it so has none.
+        self.signals = [getattr(root, name) for name in ("addedChildren", "removedChildren") if hasattr(root, name)]
+        for signal in self.signals:
+            signal.connect(self.mark_dirty)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def mark_dirty(self, *args):
+        self.dirty = True
+
+    def close(self):
+        for signal in self.signals:
+            signal.disconnect(self.mark_dirty)
+        self.signals = []
+
+    def flatten(self, nodes, depth):
+        """
+        Return the rows for the nodes and the expanded nodes under them.
+        """
+        rows = []
+        pending = [(node, depth) for node in reversed(nodes)]
+        while pending:
+            node, depth = pending.pop()
+            islayer = isinstance(node, self.layertype)
+            rows.append(LegendRow(node, depth, islayer))
+            if not islayer and node.isExpanded():
+                pending.extend((child, depth + 1) for child in reversed(node.children()))
+        return rows
+
+    def subtree_end(self, index):
+        """
+        Return the index after the last row under the row at index.
+        """
+        depth = self.rows[index].depth
+        end = index + 1
+        while end < len(self.rows) and self.rows[end].depth > depth:
+            end += 1
+        return end
+
+    def set_expanded(self, index, expanded):
+        """
+        Expand or collapse the group at index, adding or removing the rows under it.
+        """
+        row = self.rows[index]
+        if row.islayer or bool(row.node.isExpanded()) == expanded:
+            return
+        row.node.setExpanded(expanded)
+        if expanded:
+            self.rows[index + 1:index + 1] = self.flatten(row.node.children(), row.depth + 1)
+        else:
+            del self.rows[index + 1:self.subtree_end(index)]
@@ -0,0 +1,145 @@
+"""
+Latency and counter metrics for the hot paths.
+
+Each stage keeps its recent timings so percentiles can be shown in the UI or written
+out when someone says the map is slow.
+
+usage:
+    from ascii_metrics import metrics
+
+    with metrics.time("render job"):
+        ...
+    metrics.count("cache hit")
+"""
+import json
+import time
+import threading
+from functools import wraps
+from collections import deque
+from contextlib import contextmanager
+
+# The stages of getting a frame on screen in the order they happen.
+STAGES = (
+    "provider fetch",
+    "rasterize",
+    "render job",
+    "pixel conversion",
+    "compositing",
+    "blitting",
+    "legend draw",
+)
+
+
+class Latency(object):
+    """
+    Timings for one stage. Percentiles are worked out over the most recent samples.
+    """
+    def __init__(self, samples=1000):
+        self.samples = deque(maxlen=samples)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, ms):
+        self.samples.append(ms)
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, percent):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = int(round((len(ordered) - 1) * percent / 100.0))
+        return ordered[index]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count else 0.0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'max_ms': self.max,
+        }
+
+
+class Metrics(object):
+    """
+    Registry of stage latencies and counters. Safe to record into from any thread.
+    """
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.counters = {}
+
+    def record(self, name, ms):
+        with self.lock:
+            latency = self.latencies.get(name)
+            if latency is None:
+                latency = self.latencies[name] = Latency(self.samples)
+            latency.record(ms)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def time(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, (time.time() - start) * 1000.0)
+
+    def timed(self, name):
+        """
+        Decorator recording how long each call to the function takes under name.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrap(*args, **kwargs):
+                with self.time(name):
+                    return func(*args, **kwargs)
+            return wrap
+        return decorator
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'latencies': dict((name, latency.summary()) for name, latency in self.latencies.items()),
+                'counters': dict(self.counters),
+            }
+
+    def report(self):
+        """
+        Return the metrics as lines of text. The pipeline stages come first.
+        """
+        snapshot = self.snapshot()
+        latencies = snapshot['latencies']
+        names = [name for name in STAGES if name in latencies]
+        names += sorted(name for name in latencies if name not in STAGES)
+        lines = ["{:<24}{:>7}{:>10}{:>10}{:>10}".format("stage", "count", "p50 ms", "p95 ms", "max ms")]
+        for name in names:
+            summary = latencies[name]
+            lines.append("{:<24}{:>7}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+                name[:23], summary['count'], summary['p50_ms'], summary['p95_ms'], summary['max_ms']))
+        if snapshot['counters']:
+            lines.append("")
+            for name, value in sorted(snapshot['counters'].items()):
+                lines.append("{:<24}{:>7}".format(name[:23], value))
+        return "\n".join(lines)
+
+    def export(self, path):
+        snapshot = self.snapshot()
+        snapshot['created'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with open(path, "w") as f:
+            json.dump(snapshot, f, indent=2, sort_keys=True)
+
+    def reset(self):
+        with self.lock:
+            self.latencies.clear()
+            self.counters.clear()
+
+
+metrics = Metrics()
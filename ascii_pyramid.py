@@ -0,0 +1,167 @@
+"""
+Occupancy pyramids for drawing a rough map straight away when zooming.
+
+Once a project is loaded each layer is rendered over the full extent of the project at a
+fine size in the background. That grid is then halved over and over down to a few cells.
+A view at any zoom can be sampled out of the nearest level in a few milliseconds and shown
+while the real render runs.
+"""
+import math
+import numpy
+from qgis.core import QgsMapSettings
+import ascii_render
+from ascii_metrics import metrics
+
+# Cells across the longest side of the finest level.
+BASE_CELLS = 1024
+# Levels stop being halved once a side is this small.
+MIN_CELLS = 8
+
+
+def halve(grid, fill):
+    """
+    Return the grid at half the size. The largest value in each 2x2 block wins.
+    Odd sides are padded with the fill value first.
+    """
+    rows, cols = grid.shape
+    padded = numpy.full((rows + rows % 2, cols + cols % 2), fill, dtype=grid.dtype)
+    padded[:rows, :cols] = grid
+    return padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).max(axis=(1, 3))
+
+
+class Pyramid(object):
+    """
+    The grids of one source over the full extent, each half the size of the one before.
+    """
+    def __init__(self, extent, base, fill):
+        self.xmin = extent.xMinimum()
+        self.ymax = extent.yMaximum()
+        self.cellwidth = extent.width() / float(base.shape[1])
+        self.cellheight = extent.height() / float(base.shape[0])
+        self.fill = fill
+        self.levels = [base]
+        while min(self.levels[-1].shape) > MIN_CELLS:
+            self.levels.append(halve(self.levels[-1], fill))
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+    def sample(self, extent, cols, rows):
+        """
+        Return a cols by rows grid for the extent from the level closest to its cell size.
+        Cells outside the pyramid get the fill value.
+        """
+        cellwidth = extent.width() / float(cols)
+        index = int(round(math.log(cellwidth / self.cellwidth, 2)))
+        index = min(max(index, 0), len(self.levels) - 1)
+        level = self.levels[index]
+        levelwidth = self.cellwidth * 2 ** index
+        levelheight = self.cellheight * 2 ** index
+
+        xs = extent.xMinimum() + (numpy.arange(cols) + 0.5) * cellwidth
+        ys = extent.yMaximum() - (numpy.arange(rows) + 0.5) * (extent.height() / float(rows))
+        levelcols = numpy.floor((xs - self.xmin) / levelwidth).astype(int)
+        levelrows = numpy.floor((self.ymax - ys) / levelheight).astype(int)
+        insidecols = (levelcols >= 0) & (levelcols < level.shape[1])
+        insiderows = (levelrows >= 0) & (levelrows < level.shape[0])
+
+        grid = numpy.full((rows, cols), self.fill, dtype=level.dtype)
+        grid[numpy.ix_(insiderows, insidecols)] = level[numpy.ix_(levelrows[insiderows], levelcols[insidecols])]
+        return grid
+
+
+def base_view(settings):
+    """
+    Return the settings, cols and rows of the finest level for the project the settings are for.
+    The view covers the full extent of every layer.
+    :return: None if there is nothing to cover.
+    """
+    settings = QgsMapSettings(settings)
+    settings.setLayers([layer.id() for layer in ascii_render.project_layers()])
+    extent = settings.fullExtent()
+    if extent.width() <= 0 or extent.height() <= 0:
+        return None
+    xpixels, ypixels = ascii_render.cell_pixels()
+    ratio = ypixels / float(xpixels)
+    cellwidth = max(extent.width() / BASE_CELLS, extent.height() / (BASE_CELLS * ratio))
+    cols = max(1, int(math.ceil(extent.width() / cellwidth)))
+    rows = max(1, int(math.ceil(extent.height() / (cellwidth * ratio))))
+    settings.setExtent(extent)
+    settings.setOutputSize(ascii_render.output_size(cols, rows))
+    return settings, cols, rows
+
+
+def build(settings, cols, rows, key, render, fill):
+    """
+    Render the finest level of a source and put its pyramid in the pyramid cache.
+    Runs as a background task on the render worker.
+    """
+    key = key + ascii_render.view_key(settings, cols, rows)
+    if ascii_render.pyramidcache.get(key) is not None:
+        return
+    with metrics.time("pyramid build"):
+        base = render(QgsMapSettings(settings), cols, rows)
+        ascii_render.pyramidcache.put(key, Pyramid(settings.visibleExtent(), base, fill))
+
+
+def schedule(worker, settings):
+    """
+    Queue building the pyramids of every layer of the project on the render worker.
+    Anything queued for an earlier project is dropped.
+    """
+    worker.clear_background()
+    view = base_view(settings)
+    if view is None:
+        return
+    basesettings, cols, rows = view
+    layers = ascii_render.drawn_layers(ascii_render.project_layers())
+    for key, render, fill in ascii_render.grid_sources(layers):
+        worker.submit_background(build, basesettings, cols, rows, key, render, fill)
+
+
+def preview(settings, cols, rows, layers):
+    """
+    Return the CellGrid of a view sampled out of the pyramids.
+    The pyramids are looked up with the keys schedule built them under, from every layer
+    of the project, and the layers that aren't shown are left out afterwards.
+    :param layers: The layers to draw, bottom layer first.
+    :return: A CellGrid, or None if a pyramid isn't built yet.
+    """
+    view = base_view(settings)
+    if view is None:
+        return None
+    baseview = ascii_render.view_key(*view)
+    settings = QgsMapSettings(settings)
+    settings.setOutputSize(ascii_render.output_size(cols, rows))
+    extent = settings.visibleExtent()
+
+    alllayers = ascii_render.drawn_layers(ascii_render.project_layers())
+    shown = set(layer.id() for layer in ascii_render.drawn_layers(layers))
+    layers = [layer for layer in alllayers if layer.id() in shown]
+    sources = ascii_render.grid_sources(alllayers)
+    idrender = ascii_render.id_render_active()
+    grids = []
+    if idrender:
+        key, _, _ = sources.pop(0)
+        pyramid = ascii_render.pyramidcache.get(key + baseview)
+        if pyramid is None:
+            return None
+        # The ID pyramid numbers every layer of the project in the ID grid. Number the shown ones
+        # again and send the rest to -1, the last entry, like cells nothing was drawn in.
+        vectors = [layer for layer in alllayers if ascii_render.id_drawn(layer)]
+        renumber = numpy.full(len(vectors) + 1, -1, dtype=int)
+        shownids = [index for index, layer in enumerate(vectors) if layer.id() in shown]
+        renumber[shownids] = numpy.arange(len(shownids))
+        ids = pyramid.sample(extent, cols, rows)
+        grids.append(renumber[ids].astype(ids.dtype))
+    # The other sources are one per layer, or one per layer not in the ID grid in ID render mode.
+    sourcelayers = [layer for layer in alllayers if not idrender or not ascii_render.id_drawn(layer)]
+    for (key, _, _), layer in zip(sources, sourcelayers):
+        if layer.id() not in shown:
+            continue
+        pyramid = ascii_render.pyramidcache.get(key + baseview)
+        if pyramid is None:
+            return None
+        grids.append(pyramid.sample(extent, cols, rows))
+    return ascii_render.composite(grids, layers, cols, rows)
@@ -1,24 +1,42 @@
 #!/usr/bin/env python
 import time
+STARTED = time.time()
 import curses
 import curses.panel
 import os
 import sys
 import json
+import heapq
+import select
 from collections import namedtuple
 from curses.textpad import Textbox, rectangle
-from qgis.core import QgsMapLayerRegistry, QgsProject, QgsMapRendererParallelJob, QgsLayerTreeGroup, QgsLayerTreeLayer, QgsRectangle, QgsPoint, QgsMapSettings, \
-    QgsMapLayer, QGis
-from qgis.gui import QgsMapCanvas, QgsLayerTreeMapCanvasBridge
-from PyQt4.QtCore import QSize, Qt
-from PyQt4.QtGui import QColor, QImage
-from parfait import QGIS, projects
+from ascii_metrics import metrics
+from ascii_stream import damaged_runs, FrameStream, open_sink, pan_report
+from ascii_session import Recorder, COMMAND, ANSWER
+from ascii_grid import BLANK
+from ascii_legend import LegendModel
+from parfait.catalog import Catalog
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import logging
 logging.basicConfig(filename='render.log', level=logging.DEBUG)
 
+# QGIS takes a while to load so it isn't imported until init_qgis() is called
+# once the UI is up.
+app = None
+QGis = QgsProject = QgsLayerTreeGroup = QgsLayerTreeLayer = QgsRectangle = QgsMapSettings = None
+Qt = None
+projects = None
+ascii_render = None
+ascii_pyramid = None
+
 # Bunch of good old globals......for now
 scr = None
+catalog = None
 project = None
 pad = None
 legendwindow = None
@@ -27,9 +45,10 @@ ascii_mode_enabled = False
 aboutwindow = None
 modeline = None
 mapwindow = None
+renderworker = None
+eventloop = None
 canvas = None
 
-layercolormapping = {}
 colors = {}
 
 config = {}
@@ -53,14 +72,6 @@ else:
     PAGEUP = 555
     PAGEDOWN = 550
 
-codes = [
-    '@', # Point
-    '.', # Line
-    '#', # Polygon
-    ' ', # Unsupported
-    ' ' # Unknown
-]
-
 def command(names=None, *args, **kwargs):
     def escape_name(funcname):
         """
@@ -97,8 +108,6 @@ class QAndA:
 def show_commands():
     cmds = "\n".join(commands)
     aboutwindow.display(title="Commands", content=cmds)
-    aboutwindow.hide()
-    redraw_main_stuff()
 
 
 @command(names=["help", "?"])
@@ -129,10 +138,8 @@ def show_help():
 
     Running QGIS Version: {}
 
-    """.format(QGis.QGIS_VERSION)
+    """.format(QGis.QGIS_VERSION if QGis else "Still loading...")
     aboutwindow.display(title="Help", content=abouttxt)
-    aboutwindow.hide()
-    redraw_main_stuff()
 
 
 @command(names=['about', 'faq', 'wat!?'])
@@ -154,8 +161,20 @@ def show_about():
     Yes indeed because ASCII!
     """
     aboutwindow.display(title="FAQ - ESC to close", content=abouttxt)
-    aboutwindow.hide()
-    redraw_main_stuff()
+
+
+def refresh_under_modal(win):
+    """
+    Send the window to the screen, keeping any popup showing on top of it.
+
+    The map and legend are plain windows rather than panels so a refresh would draw them
+    over the popup. Renders finish whenever they like so they can't assume nothing is showing.
+    """
+    win.noutrefresh()
+    if eventloop and eventloop.modal:
+        eventloop.modal.window.touchwin()
+        curses.panel.update_panels()
+    curses.doupdate()
 
 
 def redraw_main_stuff():
@@ -163,6 +182,7 @@ def redraw_main_stuff():
     Redraw the map, legend, and clear the edit bar
     :return:
     """
+    mapwindow.invalidate()
     mapwindow.render_map()
     legendwindow.render_legend()
     pad.clear()
@@ -175,29 +195,36 @@ def _exit():
 
 
 def _resolve_project_path(name):
-    for path in config['paths']:
-        if not name.endswith(".qgs"):
-            name = name + ".qgs"
-
-        fullpath = os.path.join(path, name)
-        if os.path.exists(fullpath):
-            return fullpath
-    return None
+    return catalog.resolve(name)
 
 
 def _open_project(fullpath):
     global project
+    # Opening a project deletes the layers of the last one, nothing can still be drawing them.
+    if renderworker:
+        renderworker.cancel_all()
     project = projects.open_project(fullpath)
+    ascii_render.clear_caches()
+    ascii_render.watch_layers()
     return project
 
 
 @command(names=['load-project'])
 def open_project():
-    projectq = QAndA(question="Which project to open?", type=QAndA.QUESTION)
+    init_qgis()
+    # Pick up any projects added since the last scan.
+    catalog.start()
+    projectq = QAndA(question="Which project to open? (TAB to complete)", type=QAndA.QUESTION,
+                     completions=catalog.complete)
     project = yield projectq
     fullpath = _resolve_project_path(project)
-    while not _resolve_project_path(project):
+    while not fullpath:
         projectq.type = QAndA.QUESTIOnERROR
+        matches = catalog.matches(project, limit=5)
+        if matches:
+            projectq.question = "Which project to open? Did you mean: {}".format(", ".join(matches))
+        else:
+            projectq.question = "Which project to open? Nothing matches {}".format(project)
         project = yield projectq
         fullpath = _resolve_project_path(project)
 
@@ -208,9 +235,11 @@ def open_project():
 
     if answer[0].upper() == "Y":
         _open_project(fullpath)
-        assign_layer_colors()
+        mapwindow.settings = None
+        ascii_render.assign_layer_colors(curses.COLORS)
         legendwindow.render_legend()
         mapwindow.render_map()
+        ascii_pyramid.schedule(renderworker, mapwindow.settings)
 
 @command()
 def toggle_ascii_mode():
@@ -228,6 +257,47 @@ def toggle_color_mode():
     mapwindow.render_map()
     legendwindow.render_legend()
 
+@command()
+def toggle_id_render():
+    """
+    Switch between one render job per layer and a single job drawing every layer into an ID buffer.
+    """
+    init_qgis()
+    ascii_render.id_render_enabled = not ascii_render.id_render_enabled
+    mapwindow.render_map()
+
+@command()
+def set_render_engine():
+    """
+    Pick how layers are drawn. image renders the layer styles, direct draws the features straight into the grid.
+    """
+    init_qgis()
+    name = yield QAndA("Which engine? ({})".format("/".join(ascii_render.ENGINES)), type=QAndA.QUESTION)
+    name = name.strip().lower()
+    if name not in ascii_render.ENGINES:
+        aboutwindow.display(title="Render engine", content="Unknown engine {}".format(name))
+        return
+    ascii_render.engine = name
+    mapwindow.render_map()
+
+
+@command()
+def perf_stats():
+    report = metrics.report()
+    pans = pan_report(metrics.snapshot()['counters'])
+    if pans:
+        report += "\n\n" + pans
+    aboutwindow.display(title="Performance", content=report)
+
+@command()
+def export_perf_stats():
+    path = yield QAndA("Export to which file? (perf_stats.json)", type=QAndA.QUESTION)
+    path = path or "perf_stats.json"
+    try:
+        metrics.export(path)
+    except (IOError, OSError) as e:
+        aboutwindow.display(title="Export perf stats", content="Couldn't write {}: {}".format(path, e))
+
 @command()
 def zoom_out():
     factor = yield QAndA("By how much?", type=QAndA.QUESTION)
@@ -239,40 +309,19 @@ def zoom_in():
     mapwindow.zoom_in(float(factor))
 
 
-def assign_layer_colors():
-    """
-    Assign all the colors for each layer up front so we can use
-    it though the application.
-    """
-    import itertools
-    colors = itertools.cycle(range(11, curses.COLORS - 10))
-    layercolormapping.clear()
-    root = QgsProject.instance().layerTreeRoot()
-    layers = [node.layer() for node in root.findLayers()]
-    for layer in reversed(layers):
-        if not layer.type() == QgsMapLayer.VectorLayer:
-            continue
-        layercolormapping[layer.id()] = colors.next()
-
-
-def timeme(func):
-    def wrap(*args, **kwargs):
-        time1 = time.time()
-        ret = func(*args, **kwargs)
-        time2 = time.time()
-        logging.info('%s function took %0.3f ms' % (func.func_name, (time2-time1)*1000.0))
-        return ret
-    return wrap
-
-
 class AboutWindow():
     def __init__(self):
         y, x = scr.getmaxyx()
         self.infowin = curses.newwin(y / 2, x / 2, y / 4, x / 4)
         self.infopanel = curses.panel.new_panel(self.infowin)
         self.infowin.keypad(1)
+        self.infowin.nodelay(1)
+        self.window = self.infowin
 
     def display(self, title, content):
+        """
+        Show the window over everything else. It takes all key presses until 'q' closes it.
+        """
         curses.curs_set(0)
         self.infowin.clear()
         y, x = self.infowin.getmaxyx()
@@ -288,9 +337,15 @@ class AboutWindow():
         self.infopanel.show()
         curses.panel.update_panels()
         curses.doupdate()
-        while self.infowin.getch() != ord('q'):
-            pass
+        eventloop.modal = self
+
+    def handle_key(self, key):
+        if key != ord('q'):
+            return
+        eventloop.modal = None
+        self.hide()
         curses.curs_set(1)
+        redraw_main_stuff()
 
     def hide(self):
         self.infopanel.hide()
@@ -303,218 +358,146 @@ class Legend():
         y, x = scr.getmaxyx()
         self.win = curses.newwin(y - TOPBORDER, 30, BOTTOMBORDER, 0)
         self.win.keypad(1)
-        self.items = []
+        self.win.nodelay(1)
+        self.window = self.win
+        # The rows of the layer tree, see ascii_legend. Built when first drawn.
+        self.model = None
+        self.index = 0
+        # The row shown at the top of the window.
+        self.top = 0
         self.title = "Layers (F5)"
 
+    def current_model(self):
+        """
+        Return the rows of the project's layer tree, building them again only if the
+        tree has changed.
+        """
+        if app is None:
+            return None
+        root = QgsProject.instance().layerTreeRoot()
+        if self.model is None or self.model.dirty or self.model.root is not root:
+            if self.model is not None:
+                self.model.close()
+            self.model = LegendModel(root, QgsLayerTreeLayer)
+            self.index = min(self.index, max(len(self.model) - 1, 0))
+        return self.model
+
+    def page_size(self):
+        height, _ = self.win.getmaxyx()
+        return max(height - 2, 1)
+
+    def scroll_to(self, index):
+        """
+        Scroll so the row at index is in the window.
+        :return: True if the window scrolled.
+        """
+        top = min(self.top, index)
+        top = max(top, index - self.page_size() + 1)
+        scrolled = top != self.top
+        self.top = top
+        return scrolled
+
+    def draw_row(self, screenrow, row):
+        node = row.node
+        color = 0
+        char = ' '
+        if row.islayer:
+            if ascii_mode_enabled:
+                char = ascii_render.layer_char(node.layer())
+            if color_mode_enabled:
+                color = ascii_render.layercolormapping.get(node.layerId(), 0)
+
+        state = "[ ]"
+        if node.isVisible():
+            state = "[x]"
+
+        expanded = ' '
+        if not row.islayer:
+            if node.isExpanded():
+                expanded = '-'
+            else:
+                expanded = '+'
+
+        # This could be made generic for reuse in other places
+        parts = [
+            (expanded, 0),
+            (state, 0),
+            (char * 2, color),
+            (row.label, 0),
+        ]
+
+        currentx = row.depth + 1
+        y, maxsize = self.win.getmaxyx()
+        for part, color in parts:
+            tempx = currentx + len(part)
+            oversize = tempx > maxsize - 1
+            if oversize:
+                diff = tempx - (maxsize - 1)
+                part = part[:-diff]
+            self.win.addstr(screenrow, currentx, part, curses.color_pair(color))
+            currentx += len(part)
+            if oversize:
+                break
+
+    @metrics.timed("legend draw")
     def render_legend(self):
-        def render_item(node, row, col):
-            nodestr = str(node)
-
-            color = 0
-            char = ' '
-            islayer = False
-            if isinstance(node, QgsLayerTreeLayer):
-                nodestr = "(L) " + node.layerName()
-                if ascii_mode_enabled:
-                    char = codes[node.layer().geometryType()]
-                if color_mode_enabled:
-                    color = layercolormapping.get(node.layerId(), 0)
-                islayer = True
-            if isinstance(node, QgsLayerTreeGroup):
-                nodestr = "(G) " + node.name()
-
-
-            state = "[ ]"
-            if node.isVisible():
-                state = "[x]"
-
-            expanded = ' '
-            if not islayer:
-                if node.isExpanded():
-                    expanded = '-'
-                else:
-                    expanded = '+'
-
-            # This could be made generic for reuse in other places
-            parts = [
-                (expanded, 0),
-                (state, 0),
-                (char * 2, color),
-                (nodestr, 0),
-            ]
-
-            currentx = col
-            y, maxsize = self.win.getmaxyx()
-            for part, color in parts:
-                tempx = currentx + len(part)
-                oversize = tempx > maxsize - 1
-                if oversize:
-                    diff = tempx - (maxsize - 1)
-                    part = part[:-diff]
-                self.win.addstr(row, currentx, part, curses.color_pair(color))
-                currentx += len(part)
-                if oversize:
-                    break
-            self.items.append((nodestr, row, col + len(expanded) + 1, node))
-
-        def render_nodes(node):
-            self.items = []
-            depth = [1, 1]
-
-            def wrapped(box):
-                render_item(box, depth[0], depth[1])
-
-                if box.isExpanded():
-                    depth[1] += 1
-                    for child in box.children():
-                        depth[0] += 1
-                        wrapped(child)
-                    depth[1] -= 1
-
-            for child in node.children():
-                wrapped(child)
-                depth[0] += 1
-
-        size = 30
-        self.win.clear()
+        """
+        Draw the rows that fit in the window.
+        """
+        self.win.erase()
         self.win.box()
         self.win.addstr(0, 2, self.title, curses.A_BOLD)
-        root = QgsProject.instance().layerTreeRoot()
-        render_nodes(root)
+        model = self.current_model()
+        if model:
+            self.scroll_to(self.index)
+            for offset, row in enumerate(model.rows[self.top:self.top + self.page_size()]):
+                self.draw_row(offset + 1, row)
+        refresh_under_modal(self.win)
+
+    def move_item(self, index):
+        model = self.current_model()
+        if not model:
+            return
+        self.index = index = min(max(index, 0), len(model) - 1)
+        if self.scroll_to(index):
+            self.render_legend()
+        row = model.rows[index]
+        logging.info("Selected legend item {} at row {}".format(row.label, index))
+        self.win.move(index - self.top + 1, row.depth + 3)
         self.win.refresh()
 
     def focus(self):
-        def move_item(index):
-            try:
-                item = self.items[index]
-            except IndexError:
-                return
-            itemrow = item[1]
-            logging.info("Selected legend item {} at row {}".format(item[0], itemrow))
-            self.win.move(itemrow, item[2])
-
         modeline.update_activeWindow("Legend")
-        index = 0
-        move_item(index)
-        self.win.nodelay(1)
+        self.move_item(self.index)
         curses.curs_set(1)
-        while True:
-            char = self.win.getch()
-            if char == -1:
-                continue
-
-            logging.info(char)
-
-            try_handle_global_event(char)
-
-            if char == curses.KEY_DOWN:
-                logging.info("Down we go")
-                index += 1
-                maxindex = len(self.items)
-                if index > maxindex:
-                    index = maxindex
-                move_item(index)
-            if char == curses.KEY_UP:
-                logging.info("Up we go")
-                index -= 1
-                if index < 0:
-                    index = 0
-                move_item(index)
-            if char == 32:
-                item = self.items[index]
-                if item[3].isVisible():
-                    item[3].setVisible(Qt.Unchecked)
-                else:
-                    item[3].setVisible(Qt.Checked)
-                mapwindow.render_map()
-                self.render_legend()
-                move_item(index)
-            if char in (curses.KEY_LEFT, curses.KEY_RIGHT):
-                item = self.items[index]
-                close = char == curses.KEY_RIGHT
-                item[3].setExpanded(close)
-                self.render_legend()
-                move_item(index)
-
-
-#NOTE: Unused at the moment. Translates color into a pixel code
-# def get_pixel_value(pixels, x, y):
-#     if ascii_mode_enabled:
-#         color = "MNHQ$OC?7>!:-;. "
-#     else:
-#         color = "" * 16
-#     rgba = QColor(pixels.pixel(x, y))
-#     rgb = rgba.red(), rgba.green(), rgba.blue()
-#     index = int(sum(rgb) / 3.0 / 256.0 * 16)
-#     pair = curses.color_pair(index + 10)
-#     if ascii_mode_enabled:
-#         pair = 1
-#
-#     try:
-#         return color[index], pair
-#     except IndexError:
-#         return " ", pair
-
-@timeme
-def stack(layers, fill=(' ', 0)):
-    """
-    Stack a bunch of arrays and return a single array.
-    :param layers:
-    :param fill:
-    :return:
-    """
-    output_array = []
-    for row_stack in zip(*layers):
-        o_row = []
-        for pixel_stack in zip(*row_stack):
-            opaque_pixels = [_p for _p in pixel_stack if _p[0] != ' ']
-            if len(opaque_pixels) is 0:
-                o_row.append(fill)
+
+    def handle_key(self, char):
+        logging.info(char)
+        model = self.current_model()
+        if not model:
+            return
+
+        if char == curses.KEY_DOWN:
+            self.move_item(self.index + 1)
+        if char == curses.KEY_UP:
+            self.move_item(self.index - 1)
+        if char == curses.KEY_NPAGE:
+            self.move_item(self.index + self.page_size())
+        if char == curses.KEY_PPAGE:
+            self.move_item(self.index - self.page_size())
+        if char == 32 and len(model):
+            node = model.rows[self.index].node
+            if node.isVisible():
+                node.setVisible(Qt.Unchecked)
             else:
-                o_row.append(opaque_pixels[-1])
-        output_array.append(o_row)
-    return output_array
-
-@timeme
-def generate_layers_ascii(setttings, width, height):
-    root = QgsProject.instance().layerTreeRoot()
-    layers = [node.layer() for node in root.findLayers()
-              if node.layer().type() == QgsMapLayer.VectorLayer and node.isVisible()]
-
-    layersdata = []
-    for layer in reversed(layers):
-        colorpair = layercolormapping[layer.id()]
-        char = codes[layer.geometryType()]
-        image = render_layer(setttings, layer, width, height)
-        layerdata = []
-        for row in range(1, height - 1):
-            rowdata = []
-            for col in range(1, width - 1):
-                color = QColor(image.pixel(col, row))
-                # All non white is considered a feature.
-                # Should pull background colour from project file
-                if not color == QColor(255, 255, 255):
-                    rowdata.append((char, colorpair))
-                    rowdata.append((char, colorpair))
-                else:
-                    rowdata.append((' ', 8))
-                    rowdata.append((' ', 8))
-            layerdata.append(rowdata)
-        layersdata.append(layerdata)
-    return stack(layersdata)
-
-
-@timeme
-def render_layer(settings, layer, width, height):
-    settings.setLayers([layer.id()])
-    settings.setFlags(settings.flags() ^ QgsMapSettings.Antialiasing)
-    settings.setOutputSize(QSize(width, height))
-    job = QgsMapRendererParallelJob(settings)
-    job.start()
-    job.waitForFinished()
-    image = job.renderedImage()
-    # image.save(r"/media/nathan/Data/dev/qgis-term/{}.jpg".format(layer.name()))
-    return image
+                node.setVisible(Qt.Checked)
+            mapwindow.render_map()
+            self.render_legend()
+            self.move_item(self.index)
+        if char in (curses.KEY_LEFT, curses.KEY_RIGHT) and len(model):
+            model.set_expanded(self.index, char == curses.KEY_RIGHT)
+            self.render_legend()
+            self.move_item(self.index)
 
 
 class Map():
@@ -527,66 +510,151 @@ class Map():
         self.mapwin.keypad(1)
         self.settings = None
         self.title = "Map (F6)"
-
-    def render_map(self):
-        y, x = scr.getmaxyx()
-        x -= 30
-
-        self.mapwin.clear()
-        self.mapwin.box()
-        self.mapwin.addstr(0, 2, self.title, curses.A_BOLD)
-
+        # The last chars and colours drawn so only the changes need to be drawn next time.
+        self.frame = None
+        # Drawing the map shouldn't move the cursor out of the window with focus.
+        self.mapwin.leaveok(1)
+        self.mapwin.nodelay(1)
+        self.window = self.mapwin
+        # Frames are also sent as deltas to a FrameStream when streaming, see stream_to.
+        self.stream = None
+        # The stream draws the map on the terminal itself instead of curses.
+        self.streamonly = False
+        # The pending render is for a pan, counted separately by the stream.
+        self.panning = False
+        # When a frame was last drawn.
+        self.drawn = None
+
+    def stream_to(self, target):
+        """
+        Send every frame to the target as a delta from the last, see ascii_stream.open_sink.
+        When the target is the terminal the map cells are drawn with the deltas instead
+        of curses, which repaints more than it needs to.
+        """
+        self.streamonly = target in ("terminal", "-")
+        if self.streamonly:
+            top, left = self.mapwin.getbegyx()
+            self.stream = FrameStream(open_sink(target), top + 1, left + 1, keepcursor=True)
+        else:
+            self.stream = FrameStream(open_sink(target), clearfirst=True)
+
+    def render_map(self, pan=None):
+        """
+        Send the current view to the render worker. The map is drawn once the render
+        finishes, see poll_render.
+        :param pan: (optional) A (settings, dx, dy) tuple for the view before a pan.
+        """
         height, width = self.mapwin.getmaxyx()
+        if self.frame is None or self.frame.shape != (height - 2, width - 2):
+            self.mapwin.erase()
+            self.mapwin.box()
+            self.mapwin.addstr(0, 2, self.title, curses.A_BOLD)
+            self.frame = None
+            if self.stream:
+                self.stream.reset()
+
         # Only render the image if we have a open project
         if not self.settings and project:
             self.settings = project.map_settings
 
         if project:
-            settings = self.settings
-            data = generate_layers_ascii(self.settings, width, height)
-            for row, rowdata in enumerate(data, start=1):
-                if row >= height:
-                    break
-
-                for col, celldata in enumerate(rowdata, start=1):
-                    if col >= width - 1:
-                        break
-
-                    value, color = celldata[0], celldata[1]
-                    if value == ' ':
-                        color = 8
-                    if not ascii_mode_enabled:
-                        value = ' '
+            renderworker.submit(ascii_render.render_view, QgsMapSettings(self.settings), width - 2, height - 2,
+                                ascii_render.visible_layers(), pan)
+            self.panning = pan is not None
+            modeline.update_status("Rendering...")
+
+        # Other windows may have been drawn over us so let curses resend what is on screen.
+        # When streaming to the terminal curses only knows about the border, resending the
+        # window would blank the map so that only happens after invalidate().
+        if not self.streamonly or self.frame is None:
+            self.mapwin.touchwin()
+        refresh_under_modal(self.mapwin)
+
+    def invalidate(self):
+        """
+        Forget what is on screen so the next frame is drawn in full.
+        """
+        self.frame = None
+        if self.stream:
+            self.stream.reset()
 
-                    if not color_mode_enabled:
-                        color = 0
+    def poll_render(self):
+        """
+        Draw the latest finished render, if there is one. Renders that were superseded
+        while running are dropped.
+        """
+        try:
+            generation, result = renderworker.results.get_nowait()
+        except queue.Empty:
+            return
+        if not renderworker.latest(generation):
+            return
 
-                    self.mapwin.addstr(row, col, value, curses.color_pair(color))
+        modeline.update_status("")
+        if result is None:
+            return
+        self.draw_grid(result, pan=self.panning)
 
-        self.mapwin.refresh()
+    def draw_grid(self, grid, pan=False):
+        height, width = self.mapwin.getmaxyx()
+        grid = grid[:height - 2, :width - 2].copy()
+        grid.colours[grid.chars == BLANK] = 8
+        if not ascii_mode_enabled:
+            grid.chars[...] = BLANK
+        if not color_mode_enabled:
+            grid.colours[...] = 0
+        if self.stream:
+            self.stream.send(grid, pan)
+        if self.streamonly:
+            self.frame = grid
+        else:
+            self.blit(grid)
+            self.mapwin.touchwin()
+            refresh_under_modal(self.mapwin)
+
+        self.drawn = time.time()
+        if eventloop and eventloop.lastkey:
+            metrics.record("key to frame", (self.drawn - eventloop.lastkey) * 1000.0)
+            eventloop.lastkey = None
+
+    @metrics.timed("blitting")
+    def blit(self, grid):
+        """
+        Draw the cells that changed since the last frame, one addstr per run of the same colour.
+        """
+        for row, col, endcol, color in damaged_runs(grid, self.frame):
+            text = grid.chars[row, col:endcol].tobytes().decode("ascii")
+            self.mapwin.addstr(row + 1, col + 1, text, curses.color_pair(color))
+        self.frame = grid
 
     def focus(self):
         modeline.update_activeWindow("Map")
         curses.curs_set(0)
-        while True:
-            event = self.mapwin.getch()
-            # if event == -1:
-            #     continue
-            logging.info(event)
-            try_handle_global_event(event)
-
-            if event == curses.KEY_UP:
-                self.pan("up")
-            if event == curses.KEY_DOWN:
-                self.pan("down")
-            if event == curses.KEY_LEFT:
-                self.pan("left")
-            if event == curses.KEY_RIGHT:
-                self.pan("right")
-            if event == curses.KEY_NPAGE:
-                self.zoom_out(5)
-            if event == curses.KEY_PPAGE:
-                self.zoom_in(5)
+
+    def handle_key(self, event):
+        logging.info(event)
+        if event == curses.KEY_UP:
+            self.pan("up")
+        if event == curses.KEY_DOWN:
+            self.pan("down")
+        if event == curses.KEY_LEFT:
+            self.pan("left")
+        if event == curses.KEY_RIGHT:
+            self.pan("right")
+        if event == curses.KEY_NPAGE:
+            self.zoom_out(5)
+        if event == curses.KEY_PPAGE:
+            self.zoom_in(5)
+
+    def draw_preview(self):
+        """
+        Draw the view from the occupancy pyramids, if they are built, so there is something
+        on screen at the new zoom while the render runs.
+        """
+        height, width = self.mapwin.getmaxyx()
+        result = ascii_pyramid.preview(self.settings, width - 2, height - 2, ascii_render.visible_layers())
+        if result is not None:
+            self.draw_grid(result)
 
     def zoom_out(self, factor):
         if not self.settings:
@@ -594,6 +662,7 @@ class Map():
         extent = self.settings.extent()
         extent.scale(float(factor), None)
         self.settings.setExtent(extent)
+        self.draw_preview()
         self.render_map()
 
     def zoom_in(self, factor):
@@ -602,58 +671,77 @@ class Map():
         extent = self.settings.extent()
         extent.scale(1 / float(factor), None)
         self.settings.setExtent(extent)
+        self.draw_preview()
         self.render_map()
 
     def pan(self, direction):
         if not self.settings:
             return
 
-        def setCenter(point):
-            x, y = point.x(), point.y()
-            rect = QgsRectangle(x - extent.width() / 2.0, y - extent.height() / 2.0,
-                                x + extent.width() / 2.0, y + extent.height() / 2.0)
-            self.settings.setExtent(rect)
-            self.render_map()
+        # Move by whole cells so the cached grids line up with the new view.
+        height, width = self.mapwin.getmaxyx()
+        rows, cols = height - 2, width - 2
+        self.settings.setOutputSize(ascii_render.output_size(cols, rows))
+        xpixels, ypixels = ascii_render.cell_pixels()
+        mupp = self.settings.mapUnitsPerPixel()
+        dx, dy = {
+            "up": (0, rows // 4),
+            "down": (0, -(rows // 4)),
+            "left": (-(cols // 4), 0),
+            "right": (cols // 4, 0),
+        }[direction]
 
-        extent = self.settings.visibleExtent()
-        dx = abs(extent.width() / 4)
-        dy = abs(extent.height() / 4)
         extent = self.settings.extent()
         center = extent.center()
-
-        if direction == "up":
-            newpoint = QgsPoint(center.x() + 0, center.y() + dy)
-            setCenter(newpoint)
-        if direction == "down":
-            newpoint = QgsPoint(center.x() - 0, center.y() - dy)
-            setCenter(newpoint)
-        if direction == "left":
-            newpoint = QgsPoint(center.x() - dx, center.y() - 0)
-            setCenter(newpoint)
-        if direction == "right":
-            newpoint = QgsPoint(center.x() + dx, center.y() + 0)
-            setCenter(newpoint)
+        x, y = center.x() + dx * xpixels * mupp, center.y() + dy * ypixels * mupp
+        rect = QgsRectangle(x - extent.width() / 2.0, y - extent.height() / 2.0,
+                            x + extent.width() / 2.0, y + extent.height() / 2.0)
+        oldsettings = QgsMapSettings(self.settings)
+        self.settings.setExtent(rect)
+        self.render_map(pan=(oldsettings, dx, dy))
 
 class ModeLine():
     def __init__(self):
         y, x = scr.getmaxyx()
         self.modeline = curses.newwin(1, x, y - 1, 0)
         self.modeline.bkgd(curses.color_pair(6))
+        self.modeline.leaveok(1)
         self.modeline.refresh()
+        self.window = ""
+        self.status = ""
 
     def update_activeWindow(self, name):
+        self.window = name
+        self.draw()
+
+    def update_status(self, status):
+        self.status = status
+        self.draw()
+
+    def draw(self):
         self.modeline.erase()
-        self.modeline.addstr(0, 0, "Window: {}".format(name))
+        self.modeline.addstr(0, 0, "Window: {}".format(self.window))
+        if self.status:
+            self.modeline.addstr(0, 30, self.status, curses.A_BOLD)
         self.modeline.refresh()
 
 
+ENTERCOMMANDSTR = "Enter command. TAB for auto complete. (command-list for command help or ? for general help)"
+
+
 class EditPad():
     def __init__(self):
         y, x = scr.getmaxyx()
         self.edit = curses.newwin(1, x, y - 2, 0)
         self.status = curses.newwin(1, x, y - 3, 0)
+        self.edit.nodelay(1)
+        self.window = self.edit
         self.pad = Textbox(self.edit, insert_mode=True)
         self.lastcmd = []
+        # The running command generator waiting on an answer, if any.
+        self.command = None
+        # The QAndA the running command is waiting on.
+        self.question = None
 
     def update_cmd_status(self, message, color=None):
         if not color:
@@ -668,40 +756,72 @@ class EditPad():
     def focus(self):
         modeline.update_activeWindow("Command Entry")
         self.edit.erase()
-        entercommandstr = "Enter command. TAB for auto complete. (command-list for command help or ? for general help)"
-        pad.update_cmd_status(entercommandstr)
-
+        self.command = None
+        self.question = None
+        pad.update_cmd_status(ENTERCOMMANDSTR)
         curses.curs_set(1)
-        while True:
-            message = self.pad.edit(validate=self.handle_key_event).strip()
-            try:
-                cmd = commands[message]
-            except KeyError:
-                self.update_cmd_status("Unknown command: {}".format(message), colors['red'])
-                continue
+        self.edit.refresh()
 
-            if message not in self.lastcmd:
-                self.lastcmd.append(message)
+    def handle_key(self, key):
+        """
+        Feed a key to the text box, running the entered line once enter is pressed.
+        """
+        key = self.handle_key_event(key)
+        if not key:
+            return
+        if not self.pad.do_command(key):
+            message = self.pad.gather().strip()
+            self.edit.erase()
+            self.run_message(message)
+        self.edit.refresh()
 
-            func = cmd()
-            if not func:
-                self.update_cmd_status(entercommandstr)
-                self.edit.clear()
-                self.edit.refresh()
-                continue
+    def run_message(self, message):
+        """
+        Run the entered line as a command or, if a command asked a question, as its answer.
+        """
+        if eventloop.recorder:
+            eventloop.recorder.message(ANSWER if self.command else COMMAND, message)
+        if self.command:
+            self.answer(message)
+            return
 
-            try:
-                qanda = func.send(None)
-                while True:
-                    self.edit.clear()
-                    self.update_cmd_status(qanda.question, color=curses.color_pair(qanda.type))
-                    message = self.pad.edit(validate=self.handle_key_event).strip()
-                    qanda = func.send(message)
-            except StopIteration:
-                pass
+        try:
+            cmd = commands[message]
+        except KeyError:
+            self.update_cmd_status("Unknown command: {}".format(message), colors['red'])
+            return
 
-            self.update_cmd_status(entercommandstr)
-            self.edit.erase()
+        if message not in self.lastcmd:
+            self.lastcmd.append(message)
+
+        func = cmd()
+        if not func:
+            self.update_cmd_status(ENTERCOMMANDSTR)
+            return
+
+        self.command = func
+        self.answer(None)
+
+    def answer(self, message):
+        try:
+            qanda = self.command.send(message)
+        except StopIteration:
+            self.command = None
+            self.question = None
+            self.update_cmd_status(ENTERCOMMANDSTR)
+            return
+        self.question = qanda
+        self.update_cmd_status(qanda.question, color=curses.color_pair(qanda.type))
+
+    def complete_answer(self, text):
+        """
+        Return what the text completes to using the completions of the question being asked.
+        """
+        completions = self.question.completions
+        if callable(completions):
+            return completions(text)
+        matches = [option for option in completions if option.startswith(text)]
+        return matches[0] if matches else None
 
     def clear(self):
         self.edit.erase()
@@ -723,7 +843,13 @@ class EditPad():
             self.edit.addstr(0, 0, cmd)
             self.edit.refresh()
 
-        try_handle_global_event(event)
+        if event == 9 and self.command and self.question:
+            completed = self.complete_answer(self.pad.gather().strip())
+            if completed:
+                self.edit.clear()
+                self.edit.addstr(0, 0, completed)
+                self.edit.refresh()
+            return event
 
         if event == 9:
             logging.info("Calling auto complete on TAB key")
@@ -741,12 +867,185 @@ class EditPad():
 
 
 def try_handle_global_event(event):
-    if event == curses.KEY_F5:
-        legendwindow.focus()
-    if event == curses.KEY_F6:
-        mapwindow.focus()
-    if event == curses.KEY_F7:
-        pad.focus()
+    """
+    Move the focus for the global window keys.
+    :return: True if the key was handled.
+    """
+    windows = {
+        curses.KEY_F5: legendwindow,
+        curses.KEY_F6: mapwindow,
+        curses.KEY_F7: pad,
+    }
+    if event in windows:
+        eventloop.focus(windows[event])
+        return True
+    return False
+
+
+class EventLoop():
+    """
+    The one loop the UI runs from.
+
+    Sleeps in select on stdin, a wake up pipe and the next timer. Keys go to the modal
+    window if one is open or else to the window with focus. Other threads hand work to the
+    UI thread with post().
+    """
+    def __init__(self):
+        self.focused = None
+        self.modal = None
+        self.timers = []
+        self.timercount = 0
+        self.posted = queue.Queue()
+        self.wakeread, self.wakewrite = os.pipe()
+        # Keys are written to the recorder when recording a session, see ascii_session.
+        self.recorder = None
+        # When the last key was dispatched, for timing how long until the map is drawn.
+        self.lastkey = None
+
+    def focus(self, window):
+        self.focused = window
+        window.focus()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Run callback(*args) on the UI thread after delay seconds.
+        """
+        self.timercount += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.timercount, callback, args))
+
+    def post(self, callback, *args):
+        """
+        Run callback(*args) on the UI thread as soon as possible. Safe to call from any thread.
+        """
+        self.posted.put((callback, args))
+        os.write(self.wakewrite, b"x")
+
+    def dispatch(self, key):
+        if self.recorder:
+            self.recorder.key(key)
+        self.lastkey = time.time()
+        if self.modal:
+            self.modal.handle_key(key)
+        elif not try_handle_global_event(key):
+            self.focused.handle_key(key)
+
+    def run_once(self):
+        timeout = None
+        if self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+
+        stdin = sys.stdin.fileno()
+        ready, _, _ = select.select([stdin, self.wakeread], [], [], timeout)
+
+        if self.wakeread in ready:
+            self.run_posted()
+
+        if stdin in ready:
+            # curses buffers keys itself so read until it has nothing left.
+            while True:
+                window = self.modal or self.focused
+                key = window.window.getch()
+                if key == -1:
+                    break
+                self.dispatch(key)
+
+        self.run_timers()
+
+    def run_posted(self):
+        """
+        Run the callbacks posted from other threads.
+        """
+        os.read(self.wakeread, 4096)
+        while True:
+            try:
+                callback, args = self.posted.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+
+    def run_timers(self):
+        while self.timers and self.timers[0][0] <= time.time():
+            _, _, callback, args = heapq.heappop(self.timers)
+            callback(*args)
+
+    def run(self):
+        while True:
+            self.run_once()
+
+
+def init_qgis():
+    """
+    Load QGIS, the data providers and the render pipeline.
+
+    This is the slow part of starting up so main() leaves it until the first frame is on
+    screen. Anything that needs QGIS calls this first, it only does the work once.
+    QgsApplication has to be made on the main thread so this runs on the UI thread.
+    """
+    global app, renderworker, projects, ascii_render, ascii_pyramid
+    global QGis, QgsProject, QgsLayerTreeGroup, QgsLayerTreeLayer, QgsRectangle, QgsMapSettings, Qt
+    if app is not None:
+        return
+
+    with metrics.time("qgis init"):
+        from qgis.core import QGis, QgsProject, QgsLayerTreeGroup, QgsLayerTreeLayer, QgsRectangle, QgsMapSettings
+        from PyQt4.QtCore import Qt
+        from parfait import QGIS, projects
+        import ascii_render
+        import ascii_pyramid
+        app = QGIS.init(guienabled=False)
+
+    ascii_render.id_render_enabled = config.get('idrender', False)
+    ascii_render.rendercache.resize(config.get('cachesize', 64) * 1024 * 1024)
+    ascii_render.lodcache.resize(config.get('lodcachesize', 32) * 1024 * 1024)
+    ascii_render.pyramidcache.resize(config.get('pyramidcachesize', 16) * 1024 * 1024)
+    ascii_render.cell_aspect = config.get('cellaspect', 2)
+    ascii_render.supersample = config.get('supersample', 1)
+    ascii_render.engine = config.get('engine', 'image')
+    renderworker = ascii_render.RenderWorker()
+    if eventloop:
+        renderworker.notify = lambda: eventloop.post(mapwindow.poll_render)
+    renderworker.start()
+    logging.info("QGIS loaded after {:0.1f} ms".format((time.time() - STARTED) * 1000.0))
+
+
+def init_remote(path):
+    """
+    Render with an ascii_daemon server instead of loading QGIS here.
+
+    ascii_client stands in for the render pipeline and the QGIS classes the UI uses, so
+    the rest of the UI doesn't know the difference.
+    """
+    global app, renderworker, projects, ascii_render, ascii_pyramid
+    global QGis, QgsProject, QgsLayerTreeGroup, QgsLayerTreeLayer, QgsRectangle, QgsMapSettings, Qt
+    import ascii_client
+    with metrics.time("qgis init"):
+        app = ascii_client.connect(path)
+
+    projects = ascii_render = ascii_pyramid = ascii_client
+    QGis = ascii_client.RemoteVersion
+    QgsProject = ascii_client.RemoteProject
+    QgsLayerTreeGroup = ascii_client.RemoteGroup
+    QgsLayerTreeLayer = ascii_client.RemoteLayer
+    QgsRectangle = ascii_client.Rectangle
+    QgsMapSettings = ascii_client.ViewSettings
+    Qt = ascii_client.CheckState
+
+    ascii_render.id_render_enabled = config.get('idrender', False)
+    ascii_render.cell_aspect = config.get('cellaspect', 2)
+    ascii_render.supersample = config.get('supersample', 1)
+    ascii_render.engine = config.get('engine', 'image')
+    renderworker = ascii_render.RenderWorker()
+    if eventloop:
+        renderworker.notify = lambda: eventloop.post(mapwindow.poll_render)
+    renderworker.start()
+    logging.info("Connected to render server {}".format(path))
+
+
+def load_qgis_when_idle():
+    modeline.update_status("Loading QGIS...")
+    init_qgis()
+    modeline.update_status("")
+    legendwindow.render_legend()
 
 
 def init_colors():
@@ -779,11 +1078,15 @@ def init_colors():
         curses.init_pair(i + maprange, 0, i)
 
 
-def main(screen):
+def start(screen, daemon=None, stream=None, record=None):
     """
-    Main entry point
+    Set up the UI on the screen and draw the first frame. The event loop isn't run so
+    the UI can also be driven headless, see benchmarks/replay.py.
     :param screen:
-    :return:
+    :param daemon: (optional) Socket of an ascii_daemon to render with instead of QGIS.
+    :param stream: (optional) Where to send the map as a stream of delta frames, see
+    ascii_stream.open_sink.
+    :param record: (optional) File to record the keys of the session to, see ascii_session.
     """
     logging.info("Supports color: {}".format(curses.can_change_color()))
     logging.info("Colors: {}".format(curses.COLORS))
@@ -793,19 +1096,34 @@ def main(screen):
         global config
         config = json.load(f)
 
+    global catalog
+    catalog = Catalog(config['paths'], config.get('catalog', 'project_catalog.json'))
+    catalog.start()
 
     init_colors()
 
     screen.refresh()
 
-    global scr, pad, aboutwindow, legendwindow, mapwindow, modeline
+    global scr, pad, aboutwindow, legendwindow, mapwindow, modeline, eventloop
     scr = screen
+    eventloop = EventLoop()
+    if record:
+        lines, cols = screen.getmaxyx()
+        eventloop.recorder = Recorder(record, cols, lines)
     pad = EditPad()
     modeline = ModeLine()
     mapwindow = Map()
     legendwindow = Legend()
     aboutwindow = AboutWindow()
 
+    stream = stream or config.get('stream')
+    if stream:
+        mapwindow.stream_to(stream)
+
+    daemon = daemon or config.get('daemon')
+    if daemon:
+        init_remote(daemon)
+
     legendwindow.render_legend()
     mapwindow.render_map()
 
@@ -813,15 +1131,41 @@ def main(screen):
     screen.addstr(0, 5, " QGIS Enterprise", curses.color_pair(4))
     screen.refresh()
 
+    eventloop.focus(pad)
     if config.get('showhelp', True):
         show_help()
 
-    pad.focus()
+    firstframe = (time.time() - STARTED) * 1000.0
+    metrics.record("time to first frame", firstframe)
+    logging.info("First frame after {:0.1f} ms".format(firstframe))
+
+    # Load QGIS once the loop has drawn everything and is idle.
+    if not daemon:
+        eventloop.call_later(0, load_qgis_when_idle)
 
 
-app = QGIS.init(guienabled=False)
+def main(screen, daemon=None, stream=None, record=None):
+    """
+    Main entry point
+    :param screen:
+    :return:
+    """
+    start(screen, daemon, stream, record)
+    eventloop.run()
+
 
 if __name__ == "__main__":
     logging.info("Staring QGIS ASCII :)")
     logging.info("ASCII QGIS because we can")
-    curses.wrapper(main)
+    import argparse
+    from ascii_daemon import default_socket
+    parser = argparse.ArgumentParser(description="ASCII QGIS")
+    parser.add_argument("--connect", metavar="SOCKET", nargs="?", const=default_socket(),
+                        help="Render with the ascii_daemon listening on SOCKET. Defaults to the socket "
+                             "ascii_daemon listens on by default.")
+    parser.add_argument("--stream", metavar="TARGET",
+                        help="Send the map as delta frames to 'terminal', 'unix:PATH' or 'HOST:PORT'.")
+    parser.add_argument("--record", metavar="FILE", help="Record the keys of the session to FILE for replaying.")
+    args = parser.parse_args()
+    curses.wrapper(main, args.connect, args.stream, args.record)
+
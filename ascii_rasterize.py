@@ -0,0 +1,244 @@
+"""
+Draw vector layers straight into a grid of cells without going through a QImage.
+
+The features in view are fetched with a QgsFeatureRequest and their points, lines and
+polygon interiors are marked in a boolean grid with numpy. There is no symbology,
+antialiasing or image to read back so dense layers are much cheaper than a render job.
+Features are drawn whatever the layer renderer would do with them.
+"""
+import math
+import numpy
+from qgis.core import QgsFeatureRequest, QgsGeometry, QGis
+from ascii_metrics import metrics
+
+# How often, in features, to check if the render has been cancelled.
+CHECK_EVERY = 1000
+
+
+def _coords(points):
+    return numpy.array([(point.x(), point.y()) for point in points], dtype=float).reshape(-1, 2)
+
+
+def _stack(arrays, columns):
+    if not arrays:
+        return numpy.empty((0, columns))
+    return numpy.concatenate(arrays)
+
+
+class Geometry(object):
+    """
+    Feature geometry of a layer as arrays of map coordinates ready to draw into a grid.
+    """
+    def __init__(self, points, lines, edges, parts):
+        """
+        :param points: (n, 2) array of points.
+        :param lines: (n, 4) array of x0, y0, x1, y1 line segments.
+        :param edges: (n, 4) array of x0, y0, x1, y1 polygon ring edges.
+        :param parts: (n,) array numbering the polygon each edge belongs to so holes cancel
+        out the right polygon.
+        """
+        self.points = points
+        self.lines = lines
+        self.edges = edges
+        self.parts = parts
+
+    @property
+    def nbytes(self):
+        return self.points.nbytes + self.lines.nbytes + self.edges.nbytes + self.parts.nbytes
+
+    def simplified(self, tolerance):
+        """
+        Return a copy with every vertex snapped to a grid tolerance map units apart.
+
+        Segments that snap to nothing become points and repeated points and lines are
+        dropped. Edges are snapped the same way so rings stay closed.
+        """
+        def snap(coords):
+            return numpy.round(coords / tolerance) * tolerance
+
+        points, lines, edges = snap(self.points), snap(self.lines), snap(self.edges)
+        shortlines = (lines[:, 0] == lines[:, 2]) & (lines[:, 1] == lines[:, 3])
+        shortedges = (edges[:, 0] == edges[:, 2]) & (edges[:, 1] == edges[:, 3])
+        points = numpy.concatenate([points, lines[shortlines, :2], edges[shortedges, :2]])
+        if len(points):
+            points = numpy.unique(points, axis=0)
+        lines = lines[~shortlines]
+        if len(lines):
+            lines = numpy.unique(lines, axis=0)
+        return Geometry(points, lines, edges[~shortedges], self.parts[~shortedges])
+
+
+def zoom_band(cellsize):
+    """
+    Return the power of two zoom band a cell size in map units falls in.
+    """
+    return 2.0 ** math.floor(math.log(cellsize, 2))
+
+
+def fetch_geometry(settings, layer, check=None, wholelayer=False):
+    """
+    Fetch the geometry of the features of the layer in the visible extent, in map coordinates.
+    :param check: (optional) Called every so often, can raise to stop the fetch.
+    :param wholelayer: Fetch every feature of the layer, not just those in view.
+    :return: A Geometry.
+    """
+    points, lines, edges, parts = [], [], [], []
+    transform = settings.layerTransform(layer)
+    request = QgsFeatureRequest().setSubsetOfAttributes([])
+    if not wholelayer:
+        request.setFilterRect(settings.mapToLayerCoordinates(layer, settings.visibleExtent()))
+    part = 0
+    with metrics.time("provider fetch"):
+        for count, feature in enumerate(layer.getFeatures(request)):
+            if check and count % CHECK_EVERY == 0:
+                check()
+            geometry = feature.geometry()
+            if geometry is None:
+                continue
+            if transform:
+                geometry = QgsGeometry(geometry)
+                geometry.transform(transform)
+
+            kind = geometry.type()
+            multi = geometry.isMultipart()
+            if kind == QGis.Point:
+                points.append(_coords(geometry.asMultiPoint() if multi else [geometry.asPoint()]))
+            elif kind == QGis.Line:
+                for line in (geometry.asMultiPolyline() if multi else [geometry.asPolyline()]):
+                    line = _coords(line)
+                    if len(line) == 1:
+                        points.append(line)
+                    else:
+                        lines.append(numpy.hstack([line[:-1], line[1:]]))
+            elif kind == QGis.Polygon:
+                for polygon in (geometry.asMultiPolygon() if multi else [geometry.asPolygon()]):
+                    for ring in polygon:
+                        ring = _coords(ring)
+                        if not len(ring):
+                            continue
+                        # Join the ring back onto its first point. A closed ring just gets an empty edge.
+                        ring = numpy.vstack([ring, ring[:1]])
+                        edges.append(numpy.hstack([ring[:-1], ring[1:]]))
+                        parts.append(numpy.repeat(part, len(ring) - 1))
+                    part += 1
+    parts = numpy.concatenate(parts) if parts else numpy.empty(0, dtype=int)
+    return Geometry(_stack(points, 2), _stack(lines, 4), _stack(edges, 4), parts)
+
+
+def to_cells(coords, extent, cellwidth, cellheight):
+    """
+    Convert map coordinates to fractional (col, row) cell coordinates. Row 0 is the top of the extent.
+    """
+    cols = (coords[:, 0] - extent.xMinimum()) / cellwidth
+    rows = (extent.yMaximum() - coords[:, 1]) / cellheight
+    return cols, rows
+
+
+def mark_points(grid, cols, rows):
+    """
+    Mark the cells the points fall in.
+    """
+    height, width = grid.shape
+    cols = numpy.floor(cols).astype(int)
+    rows = numpy.floor(rows).astype(int)
+    inside = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+    grid[rows[inside], cols[inside]] = True
+
+
+def clip_segments(x0, y0, x1, y1, width, height):
+    """
+    Clip segments to the grid using Liang-Barsky.
+    :return: The clipped x0, y0, x1, y1 of the segments that cross the grid.
+    """
+    dx, dy = x1 - x0, y1 - y0
+    start = numpy.zeros(len(x0))
+    end = numpy.ones(len(x0))
+    keep = numpy.ones(len(x0), dtype=bool)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, x0), (dx, width - x0), (-dy, y0), (dy, height - y0)):
+            ratio = q / p
+            keep &= ~((p == 0) & (q < 0))
+            start = numpy.where(p < 0, numpy.maximum(start, ratio), start)
+            end = numpy.where(p > 0, numpy.minimum(end, ratio), end)
+    keep &= start <= end
+    start, end = start[keep], end[keep]
+    x0, y0, dx, dy = x0[keep], y0[keep], dx[keep], dy[keep]
+    return x0 + start * dx, y0 + start * dy, x0 + end * dx, y0 + end * dy
+
+
+def mark_segments(grid, x0, y0, x1, y1):
+    """
+    Mark the cells the segments pass through. Each segment is sampled twice per cell it crosses.
+    """
+    height, width = grid.shape
+    x0, y0, x1, y1 = clip_segments(x0, y0, x1, y1, width, height)
+    if not len(x0):
+        return
+    steps = numpy.ceil(numpy.maximum(abs(x1 - x0), abs(y1 - y0)) * 2).astype(int) + 1
+    segment = numpy.repeat(numpy.arange(len(x0)), steps)
+    offsets = numpy.arange(len(segment)) - numpy.repeat(numpy.cumsum(steps) - steps, steps)
+    t = offsets / numpy.repeat(numpy.maximum(steps - 1, 1), steps).astype(float)
+    cols = x0[segment] + t * (x1 - x0)[segment]
+    rows = y0[segment] + t * (y1 - y0)[segment]
+    # Points on the far edge of the grid belong to the last cell.
+    mark_points(grid, numpy.minimum(cols, width - 1e-9), numpy.minimum(rows, height - 1e-9))
+
+
+def fill_polygons(grid, x0, y0, x1, y1, parts):
+    """
+    Scanline fill the polygons made by the edges. A cell is filled when its centre is inside.
+    :param parts: The polygon each edge belongs to. Rings of the same polygon use even-odd
+    so holes are left empty.
+    """
+    height, width = grid.shape
+    low, high = numpy.minimum(y0, y1), numpy.maximum(y0, y1)
+    # Rows whose centre line is in [low, high). Horizontal edges cross no rows.
+    first = numpy.maximum(numpy.ceil(low - 0.5), 0).astype(int)
+    last = numpy.minimum(numpy.ceil(high - 0.5), height).astype(int)
+    counts = numpy.maximum(last - first, 0)
+    if not counts.sum():
+        return
+    edge = numpy.repeat(numpy.arange(len(x0)), counts)
+    rows = numpy.repeat(first, counts) + numpy.arange(len(edge)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    centre = rows + 0.5
+    xs = x0[edge] + (centre - y0[edge]) * (x1 - x0)[edge] / (y1 - y0)[edge]
+
+    order = numpy.lexsort((xs, rows, parts[edge]))
+    rows, xs = rows[order], xs[order]
+    # Every closed ring crosses each row an even number of times so crossings pair up.
+    rows = rows[0::2]
+    start = numpy.clip(numpy.ceil(xs[0::2] - 0.5), 0, width).astype(int)
+    end = numpy.clip(numpy.ceil(xs[1::2] - 0.5), 0, width).astype(int)
+    spans = start < end
+    edges = numpy.zeros((height, width + 1), dtype=int)
+    numpy.add.at(edges, (rows[spans], start[spans]), 1)
+    numpy.add.at(edges, (rows[spans], end[spans]), -1)
+    grid |= numpy.cumsum(edges, axis=1)[:, :width] > 0
+
+
+def rasterize(geometry, extent, cols, rows):
+    """
+    Draw the geometry into a grid of cols by rows cells covering the extent.
+    :return: A (rows, cols) bool array, True where a feature was drawn.
+    """
+    grid = numpy.zeros((rows, cols), dtype=bool)
+    cellwidth = extent.width() / float(cols)
+    cellheight = extent.height() / float(rows)
+
+    def segments(coords):
+        x0, y0 = to_cells(coords[:, :2], extent, cellwidth, cellheight)
+        x1, y1 = to_cells(coords[:, 2:], extent, cellwidth, cellheight)
+        return x0, y0, x1, y1
+
+    with metrics.time("rasterize"):
+        if len(geometry.points):
+            mark_points(grid, *to_cells(geometry.points, extent, cellwidth, cellheight))
+        if len(geometry.lines):
+            mark_segments(grid, *segments(geometry.lines))
+        if len(geometry.edges):
+            x0, y0, x1, y1 = segments(geometry.edges)
+            # The outline keeps polygons thinner than a cell on the map.
+            mark_segments(grid, x0, y0, x1, y1)
+            fill_polygons(grid, x0, y0, x1, y1, geometry.parts)
+    return grid
+
@@ -0,0 +1,829 @@
+"""
+The render pipeline that turns the layers of the loaded project into a CellGrid of
+chars and colour pairs. Nothing in here touches curses so it can be used by the
+curses UI and headless tools alike.
+"""
+import time
+import logging
+import threading
+import numpy
+from functools import partial
+from collections import OrderedDict
+from qgis.core import QgsMapLayerRegistry, QgsProject, QgsMapRendererParallelJob, QgsRectangle, QgsMapSettings, \
+    QgsMapLayer, QgsSymbolV2, QgsSingleSymbolRendererV2, QgsVectorLayer, QgsRenderContext, QgsCoordinateTransform, \
+    QgsVectorSimplifyMethod
+from PyQt4.QtCore import QSize, QEventLoop, QTimer
+from PyQt4.QtGui import QColor, QImage, QPainter
+from ascii_metrics import metrics
+from ascii_worker import RenderWorker, check_cancelled
+from ascii_grid import CellGrid, shift_grid
+import ascii_rasterize
+
+# How often, in milliseconds, a render job on the render worker checks if it has been superseded.
+JOB_POLL_MS = 50
+
+# Draw every visible layer in a single job into an ID buffer instead of one job per layer.
+id_render_enabled = False
+
+# How layers are turned into grids. "image" renders the layer symbology with QGIS and reads
+# the image back. "direct" draws the feature geometry straight into the grid, see ascii_rasterize.
+ENGINES = ("image", "direct")
+engine = "image"
+
+layercolormapping = {}
+layertokens = {}
+
+codes = [
+    '@', # Point
+    '.', # Line
+    '#', # Polygon
+    ' ', # Unsupported
+    ' ' # Unknown
+]
+
+# All non white is considered a feature.
+# Should pull background colour from project file
+BACKGROUND = 0xFFFFFF
+
+# Raster cells get a char by how bright they are, darkest first.
+RAMP = "MNHQ$OC?7>!:-;. "
+# Raster cells take their colour pair from this lookup of 5 bit red, green and blue.
+# See build_palette.
+palettelookup = numpy.zeros((32, 32, 32), dtype=numpy.uint16)
+
+# The RGB values of the xterm 256 colour palette past the 16 system colours which
+# every terminal sets differently.
+CUBE_LEVELS = (0, 95, 135, 175, 215, 255)
+XTERM_RGB = [(r, g, b) for r in CUBE_LEVELS for g in CUBE_LEVELS for b in CUBE_LEVELS] + \
+            [(8 + 10 * grey,) * 3 for grey in range(24)]
+
+# Terminal cells are taller than they are wide. Each cell is rendered as a block of
+# supersample pixels across and cell_aspect * supersample pixels down so the map keeps
+# its shape on screen. A higher supersample picks up features thinner than a cell.
+cell_aspect = 2
+supersample = 1
+
+def assign_layer_colors(ncolors):
+    """
+    Assign all the colors for each layer up front so we can use
+    it though the application.
+    :param ncolors: The number of colours the terminal supports. curses.COLORS for curses.
+    """
+    import itertools
+    colors = itertools.cycle(range(11, ncolors - 10))
+    layercolormapping.clear()
+    root = QgsProject.instance().layerTreeRoot()
+    layers = [node.layer() for node in root.findLayers()]
+    for layer in reversed(layers):
+        if not layer.type() == QgsMapLayer.VectorLayer:
+            continue
+        layercolormapping[layer.id()] = colors.next()
+    build_palette(ncolors)
+
+
+def build_palette(ncolors):
+    """
+    Fill palettelookup with the colour pair closest to every 5 bit RGB colour.
+
+    Only colours that have a map colour pair are used, pair i + 10 has background colour i.
+    :param ncolors: The number of colours the terminal supports.
+    """
+    indexes = [index for index in range(16, 16 + len(XTERM_RGB)) if index < ncolors - 10]
+    if not indexes:
+        palettelookup[...] = 0
+        return
+    palette = numpy.array([XTERM_RGB[index - 16] for index in indexes], dtype=numpy.int32)
+    levels = numpy.arange(32) * 8 + 4
+    rgb = numpy.stack(numpy.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 1, 3)
+    nearest = ((rgb - palette) ** 2).sum(axis=2).argmin(axis=1)
+    palettelookup[...] = (numpy.array(indexes)[nearest] + 10).reshape(32, 32, 32)
+
+
+def is_raster(layer):
+    return layer.type() == QgsMapLayer.RasterLayer
+
+
+def layer_char(layer):
+    """
+    Return the char the layer is drawn with. Raster layers use a char per cell so this
+    is the darkest char of the RAMP.
+    """
+    if is_raster(layer):
+        return RAMP[0]
+    return codes[layer.geometryType()]
+
+
+def timeme(func):
+    def wrap(*args, **kwargs):
+        time1 = time.time()
+        ret = func(*args, **kwargs)
+        time2 = time.time()
+        metrics.record(func.func_name, (time2-time1)*1000.0)
+        logging.info('%s function took %0.3f ms' % (func.func_name, (time2-time1)*1000.0))
+        return ret
+    return wrap
+
+
+@timeme
+def top_layers(masks):
+    """
+    Return the index of the top most layer that occupies each cell.
+    :param masks: A (layers, rows, cols) bool array with the bottom layer first.
+    :return: A (rows, cols) int array of layer indexes. -1 where no layer occupies the cell.
+    """
+    count, rows, cols = masks.shape
+    if not count:
+        return numpy.full((rows, cols), -1, dtype=numpy.intp)
+    # argmax returns the first True so look from the top of the stack down.
+    top = count - 1 - masks[::-1].argmax(axis=0)
+    top[~masks.any(axis=0)] = -1
+    return top
+
+
+@timeme
+def stack(masks, chars, colours, fill=(' ', 0)):
+    """
+    Stack a bunch of layer masks and return a single char and colour grid.
+
+    Each cell takes the char and colour of the top most layer that occupies it.
+    :param masks: A (layers, rows, cols) bool array with the bottom layer first.
+    :param chars: The char for each layer. Layers using ' ' are treated as transparent.
+    :param colours: The colour pair for each layer.
+    :param fill: The char and colour for cells no layer occupies.
+    :return: A CellGrid.
+    """
+    opaque = numpy.array([char != ' ' for char in chars], dtype=bool)
+    top = top_layers(masks & opaque.reshape(-1, 1, 1))
+    return lookup_cells(top, chars, colours, fill)
+
+
+def lookup_cells(top, chars, colours, fill=(' ', 0)):
+    """
+    Build the char and colour grids for a grid of top most layer indexes.
+    :param top: A (rows, cols) int array of layer indexes. -1 for empty cells.
+    :param chars: The char for each layer.
+    :param colours: The colour pair for each layer.
+    :param fill: The char and colour for empty cells.
+    :return: A CellGrid.
+    """
+    # Slot 0 holds the fill so the -1 for empty cells lands on it.
+    charlookup = numpy.array([ord(fill[0])] + [ord(char) for char in chars], dtype=numpy.uint8)
+    colourlookup = numpy.array([fill[1]] + list(colours), dtype=numpy.uint16)
+    return CellGrid(charlookup[top + 1], colourlookup[top + 1])
+
+
+@metrics.timed("pixel conversion")
+def image_argb(image):
+    """
+    Return the ARGB value of every pixel in the image as a uint32 array.
+
+    The pixels are read straight from the image bits so there is no per pixel call
+    back into Qt.
+    :param image: The QImage to read.
+    :return: A (height, width) numpy uint32 array sharing memory with the image, so the
+    caller has to keep the image. Images in other formats are converted and copied.
+    """
+    converted = image.format() not in (QImage.Format_ARGB32, QImage.Format_ARGB32_Premultiplied, QImage.Format_RGB32)
+    if converted:
+        image = image.convertToFormat(QImage.Format_ARGB32)
+    bits = image.constBits()
+    bits.setsize(image.byteCount())
+    pixels = numpy.frombuffer(bits, dtype=numpy.uint32)
+    pixels = pixels.reshape(image.height(), image.bytesPerLine() // 4)[:, :image.width()]
+    if converted:
+        # The converted image is freed when this returns, the bits don't keep it alive.
+        return pixels.copy()
+    return pixels
+
+
+def image_rgb(image):
+    """
+    Return the RGB value of every pixel in the image as a uint32 array.
+
+    The alpha channel is dropped the same way QColor(image.pixel()) does.
+    :param image: The QImage to read.
+    :return: A (height, width) numpy uint32 array.
+    """
+    # The mask makes the copy we return.
+    return image_argb(image) & 0xFFFFFF
+
+
+def cell_pixels():
+    """
+    Return the (width, height) in pixels each grid cell is rendered at.
+    """
+    return supersample, cell_aspect * supersample
+
+
+def output_size(cols, rows):
+    """
+    Return the size of the image to render for a grid of cols by rows cells.
+    """
+    xpixels, ypixels = cell_pixels()
+    return QSize(cols * xpixels, rows * ypixels)
+
+
+def reduce_cells(grid, cols, rows):
+    """
+    Reduce a grid rendered at cell_pixels() per cell down to one value per cell.
+
+    The largest value in each block wins so a mask cell is set if any of its pixels are
+    and an ID buffer cell gets the top layer drawn in it.
+    """
+    xpixels, ypixels = cell_pixels()
+    if xpixels == ypixels == 1:
+        return grid
+    return grid.reshape(rows, ypixels, cols, xpixels).max(axis=(1, 3))
+
+
+@timeme
+def image_mask(image, background=BACKGROUND):
+    """
+    Return a boolean array of the image marking every pixel that isn't the background colour.
+    :param image: The QImage to read.
+    :param background: The RGB value of the background.
+    :return: A (height, width) numpy bool array.
+    """
+    return image_rgb(image) != background
+
+
+def raster_cells(image, cols, rows):
+    """
+    Turn a raster layer image rendered at cell_pixels() per cell into cell codes.
+
+    Each cell averages its pixels. The brightness picks a char from the RAMP and the colour
+    picks a pair from palettelookup. Cells that are mostly transparent are left empty.
+    :return: A (rows, cols) uint32 array of colour pair << 8 | char code. 0 for empty cells.
+    """
+    xpixels, ypixels = cell_pixels()
+    argb = image_argb(image)
+    channels = numpy.stack([(argb >> shift) & 0xFF for shift in (16, 8, 0, 24)], axis=-1)
+    channels = channels.reshape(rows, ypixels, cols, xpixels, 4).mean(axis=(1, 3))
+    alpha = channels[..., 3]
+    # The image is premultiplied so divide the alpha back out of the average.
+    rgb = numpy.clip(channels[..., :3] * 255.0 / numpy.maximum(alpha, 1)[..., None], 0, 255).astype(numpy.intp)
+    luminance = rgb[..., 0] * 0.299 + rgb[..., 1] * 0.587 + rgb[..., 2] * 0.114
+    ramp = numpy.array([ord(char) for char in RAMP], dtype=numpy.uint32)
+    chars = ramp[numpy.minimum((luminance * len(RAMP) / 256.0).astype(numpy.intp), len(RAMP) - 1)]
+    pairs = palettelookup[rgb[..., 0] >> 3, rgb[..., 1] >> 3, rgb[..., 2] >> 3].astype(numpy.uint32)
+    return numpy.where(alpha >= 128, pairs << 8 | chars, 0).astype(numpy.uint32)
+
+
+def render_raster(settings, layer, cols, rows):
+    """
+    Render a raster layer into cell codes, see raster_cells.
+
+    The image is only the size of the grid so QGIS reads just the visible window of the
+    raster from the closest overview level, never the full resolution data.
+    """
+    settings = QgsMapSettings(settings)
+    # Anything left transparent has no data.
+    settings.setBackgroundColor(QColor(0, 0, 0, 0))
+    size = output_size(cols, rows)
+    image = render_layer(settings, layer, size.width(), size.height())
+    return raster_cells(image, cols, rows)
+
+
+class RenderCache():
+    """
+    Least recently used cache of rendered layer grids bounded by the memory they use.
+    Anything with an nbytes attribute can be cached. The UI thread and the render worker
+    share the caches so every call takes the lock.
+    """
+    def __init__(self, budget, name="cache"):
+        """
+        :param budget: The most bytes of grid data to hold before evicting.
+        :param name: Prefix for the hit and miss counters in the metrics.
+        """
+        self.name = name
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                metrics.count(self.name + " miss")
+                return None
+            self.items[key] = value
+            self.hits += 1
+            metrics.count(self.name + " hit")
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key).nbytes
+            if value.nbytes > self.budget:
+                return
+            self.items[key] = value
+            self.size += value.nbytes
+            self._evict()
+
+    def resize(self, budget):
+        with self.lock:
+            self.budget = budget
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def _evict(self):
+        while self.size > self.budget:
+            _, old = self.items.popitem(last=False)
+            self.size -= old.nbytes
+
+
+rendercache = RenderCache(64 * 1024 * 1024)
+
+# Simplified copies of whole layers for the direct engine, one per zoom band. See lod_geometry.
+lodcache = RenderCache(32 * 1024 * 1024, name="lod cache")
+# Occupancy pyramids of the whole project used to preview zooms, see ascii_pyramid.
+pyramidcache = RenderCache(16 * 1024 * 1024, name="pyramid cache")
+
+# Levels too big for lodcache. They are fetched for the view like any other render.
+lodoversized = set()
+
+# Layer id to the (layer key, copy) of the copy drawn for ID renders, see id_layer.
+# Only used on the render worker.
+idlayers = {}
+
+# Providers whose layers can't be opened again from their source, a copy would be empty.
+UNCOPYABLE_PROVIDERS = ("memory",)
+
+# The direct engine draws from a level of detail copy of the whole layer when the layer is
+# no more than this many cells across at the zoom band of the view.
+LOD_CELLS = 4096
+
+
+def clear_caches():
+    rendercache.clear()
+    lodcache.clear()
+    pyramidcache.clear()
+    lodoversized.clear()
+
+
+def _bump_layer_token(layerid):
+    layertokens[layerid] = layertokens.get(layerid, 0) + 1
+
+
+def simplify_method():
+    """
+    Return how vector layers are simplified when drawn by the image engine.
+
+    Vertices closer together than a cell can't change which cells a feature covers, so
+    zoomed out views draw far fewer of them. The direct engine uses lod_geometry instead.
+    """
+    method = QgsVectorSimplifyMethod()
+    method.setSimplifyHints(QgsVectorSimplifyMethod.GeometrySimplification)
+    method.setThreshold(float(min(cell_pixels())))
+    return method
+
+
+def watch_layers():
+    """
+    Track changes to the loaded layers so cached grids for a changed layer are not reused.
+    Vector layers are also set to be simplified to the cell size, see simplify_method.
+    Call this on the UI thread after a project is opened.
+    """
+    layertokens.clear()
+    for layer in QgsMapLayerRegistry.instance().mapLayers().values():
+        layer.repaintRequested.connect(partial(_bump_layer_token, layer.id()))
+        if layer.type() == QgsMapLayer.VectorLayer:
+            layer.layerModified.connect(partial(_bump_layer_token, layer.id()))
+            layer.setSimplifyMethod(simplify_method())
+
+
+def layer_key(layer):
+    """
+    Return the part of a cache key that changes when the layer would render differently.
+    """
+    subset = layer.subsetString() if layer.type() == QgsMapLayer.VectorLayer else None
+    return layer.id(), layertokens.get(layer.id(), 0), subset
+
+
+def output_crs(settings):
+    """
+    Return the authid of the CRS layers are drawn in, None if they aren't reprojected.
+    """
+    if settings.hasCrsTransformEnabled():
+        return settings.destinationCrs().authid()
+    return None
+
+
+def view_key(settings, cols, rows):
+    """
+    Return the part of a cache key that changes when the map view changes.
+    """
+    extent = settings.extent()
+    return (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum(),
+            cols, rows, cell_pixels(), output_crs(settings))
+
+
+def project_layers(visibleonly=False):
+    """
+    Return the vector and raster layers of the project, bottom layer first.
+    :param visibleonly: Only return the layers that are visible.
+    """
+    root = QgsProject.instance().layerTreeRoot()
+    layers = [node.layer() for node in root.findLayers()
+              if node.layer().type() in (QgsMapLayer.VectorLayer, QgsMapLayer.RasterLayer)
+              and (node.isVisible() or not visibleonly)]
+    return list(reversed(layers))
+
+
+def visible_layers():
+    """
+    Return the visible layers that get drawn on the map, bottom layer first.
+    """
+    return project_layers(visibleonly=True)
+
+
+def id_render_active():
+    return id_render_enabled and engine != "direct"
+
+
+def id_drawn(layer):
+    """
+    Return True if the layer is drawn into the shared ID grid when ID render mode is on.
+    Layers that can't be copied are rendered on their own like outside ID render mode.
+    """
+    return not is_raster(layer) and layer.providerType() not in UNCOPYABLE_PROVIDERS
+
+
+def grid_sources(layers):
+    """
+    Return the grids that make up the map for the given layers.
+
+    Vector layers get an occupancy mask each, or in ID render mode share a single grid of
+    layer indexes which comes first, see id_drawn. Raster layers get a grid of cell codes each, see raster_cells.
+    :return: A list of (key, render, fill) tuples. render is called with settings, cols and rows
+    and returns a grid with one value per cell. fill is the value for cells nothing was drawn in.
+    """
+    sources = []
+    if id_render_active():
+        vectors = [layer for layer in layers if id_drawn(layer)]
+        key = (tuple(layer_key(layer) for layer in vectors),)
+
+        def render(settings, cols, rows):
+            size = output_size(cols, rows)
+            return reduce_cells(render_layer_ids(settings, vectors, size.width(), size.height()), cols, rows)
+        sources.append((key, render, -1))
+
+    for layer in layers:
+        if is_raster(layer):
+            def render(settings, cols, rows, layer=layer):
+                return render_raster(settings, layer, cols, rows)
+            sources.append((layer_key(layer), render, 0))
+        elif engine == "direct":
+            def render(settings, cols, rows, layer=layer):
+                settings = QgsMapSettings(settings)
+                settings.setOutputSize(output_size(cols, rows))
+                geometry = lod_geometry(settings, layer)
+                if geometry is None:
+                    geometry = ascii_rasterize.fetch_geometry(settings, layer, check_cancelled)
+                return ascii_rasterize.rasterize(geometry, settings.visibleExtent(), cols, rows)
+            sources.append((layer_key(layer) + ("direct",), render, False))
+        elif not id_render_active() or not id_drawn(layer):
+            def render(settings, cols, rows, layer=layer):
+                size = output_size(cols, rows)
+                mask = image_mask(render_layer(settings, layer, size.width(), size.height()))
+                return reduce_cells(mask, cols, rows)
+            sources.append((layer_key(layer), render, False))
+    return sources
+
+
+def lod_geometry(settings, layer):
+    """
+    Return the geometry of the whole layer simplified for the zoom band of the view.
+
+    Levels are made the first time a band is needed and kept in lodcache. Zoomed out views
+    then draw from a handful of vertices per cell no matter how detailed the data is.
+    :return: A Geometry, or None if the view is zoomed in too far for a copy of the whole
+    layer to be worth it.
+    """
+    cellsize = settings.mapUnitsPerPixel() * min(cell_pixels())
+    band = ascii_rasterize.zoom_band(cellsize)
+    extent = settings.layerExtentToOutputExtent(layer, layer.extent())
+    if max(extent.width(), extent.height()) / band > LOD_CELLS:
+        return None
+
+    key = layer_key(layer) + (band, output_crs(settings))
+    if key in lodoversized:
+        return None
+    geometry = lodcache.get(key)
+    if geometry is None:
+        full = ascii_rasterize.fetch_geometry(settings, layer, check_cancelled, wholelayer=True)
+        # Snapping to half the band keeps every vertex within a quarter of a cell.
+        geometry = full.simplified(band / 2.0)
+        lodcache.put(key, geometry)
+        if geometry.nbytes > lodcache.budget:
+            lodoversized.add(key)
+        logging.info("LOD for {} at {} map units: {} bytes from {} bytes".format(
+            layer.name(), band, geometry.nbytes, full.nbytes))
+    return geometry
+
+
+def cached_grid(key, render, settings, cols, rows):
+    """
+    Return the grid for the key and current view, rendering it only if it isn't in the cache.
+    """
+    key = key + view_key(settings, cols, rows)
+    grid = rendercache.get(key)
+    if grid is None:
+        grid = render(settings, cols, rows)
+        rendercache.put(key, grid)
+    return grid
+
+
+def exposed_strips(settings, dx, dy, cols, rows):
+    """
+    Return the parts of a view that a pan of dx, dy cells brings into view.
+    :param settings: The map settings for the view after the pan.
+    :return: A list of (extent, rows, cols) where rows and cols are the slices of the grid
+    the extent covers.
+    """
+    extent = settings.visibleExtent()
+    xpixels, ypixels = cell_pixels()
+    cellwidth = settings.mapUnitsPerPixel() * xpixels
+    cellheight = settings.mapUnitsPerPixel() * ypixels
+    strips = []
+    if dx > 0:
+        rect = QgsRectangle(extent.xMaximum() - dx * cellwidth, extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+        strips.append((rect, slice(0, rows), slice(cols - dx, cols)))
+    if dx < 0:
+        rect = QgsRectangle(extent.xMinimum(), extent.yMinimum(), extent.xMinimum() - dx * cellwidth, extent.yMaximum())
+        strips.append((rect, slice(0, rows), slice(0, -dx)))
+    if dy > 0:
+        rect = QgsRectangle(extent.xMinimum(), extent.yMaximum() - dy * cellheight, extent.xMaximum(), extent.yMaximum())
+        strips.append((rect, slice(0, dy), slice(0, cols)))
+    if dy < 0:
+        rect = QgsRectangle(extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMinimum() - dy * cellheight)
+        strips.append((rect, slice(rows + dy, rows), slice(0, cols)))
+    return strips
+
+
+@timeme
+def pan_cache(settings, newextent, dx, dy, cols, rows, layers):
+    """
+    Move the cached grids of the current view onto a view panned by whole cells.
+
+    The cached grids are shifted and only the strips the pan exposes are rendered so the
+    render of the new view is served from the cache. Grids that aren't cached are left for
+    the next render to draw in full.
+    :param settings: The map settings for the current view.
+    :param newextent: The extent after the pan.
+    :param dx: Cells the view moves east.
+    :param dy: Cells the view moves north.
+    :param layers: The layers to move, bottom layer first.
+    """
+    newsettings = QgsMapSettings(settings)
+    newsettings.setExtent(newextent)
+    newsettings.setOutputSize(output_size(cols, rows))
+    oldview = view_key(settings, cols, rows)
+    newview = view_key(newsettings, cols, rows)
+    strips = exposed_strips(newsettings, dx, dy, cols, rows)
+    for key, render, fill in grid_sources(layers):
+        grid = rendercache.get(key + oldview)
+        if grid is None:
+            continue
+        grid = shift_grid(grid, -dx, dy, fill)
+        for rect, striprows, stripcols in strips:
+            stripsettings = QgsMapSettings(newsettings)
+            stripsettings.setExtent(rect)
+            strip = render(stripsettings, stripcols.stop - stripcols.start, striprows.stop - striprows.start)
+            grid[striprows, stripcols] = strip
+        rendercache.put(key + newview, grid)
+
+
+@timeme
+def generate_layers_ascii(setttings, cols, rows, layers=None):
+    """
+    Return the CellGrid of cols by rows cells for the view.
+    """
+    layers = drawn_layers(layers)
+    grids = [cached_grid(key, render, setttings, cols, rows) for key, render, _ in grid_sources(layers)]
+    logging.info("Render cache {} hits {} misses {} bytes".format(rendercache.hits, rendercache.misses, rendercache.size))
+    return composite(grids, layers, cols, rows)
+
+
+def drawn_layers(layers=None):
+    """
+    Return the layers that make it onto the map out of the given layers, the visible layers by default.
+    """
+    if layers is None:
+        layers = visible_layers()
+    if id_render_active():
+        layers = [layer for layer in layers if layer_char(layer) != ' ']
+    return layers
+
+
+def composite(grids, layers, cols, rows):
+    """
+    Turn the grids of the sources from grid_sources into a CellGrid.
+    :param layers: The layers from drawn_layers the grids were made for.
+    """
+    chars = [layer_char(layer) for layer in layers]
+    colours = [layercolormapping.get(layer.id(), 0) for layer in layers]
+    rasters = [index for index, layer in enumerate(layers) if is_raster(layer)]
+    idrender = id_render_active()
+    with metrics.time("compositing"):
+        if idrender and all(id_drawn(layer) for layer in layers):
+            return lookup_cells(grids[0], chars, colours)
+
+        grids = iter(grids)
+        ids = next(grids) if idrender else None
+        masks = numpy.zeros((len(layers), rows, cols), dtype=bool)
+        cells = {}
+        vectorindex = 0
+        for index, layer in enumerate(layers):
+            if index in rasters:
+                cells[index] = next(grids)
+                masks[index] = cells[index] != 0
+            elif idrender and id_drawn(layer):
+                masks[index] = ids == vectorindex
+                vectorindex += 1
+            else:
+                masks[index] = next(grids)
+
+        if not rasters:
+            return stack(masks, chars, colours)
+
+        opaque = numpy.array([char != ' ' for char in chars], dtype=bool)
+        top = top_layers(masks & opaque.reshape(-1, 1, 1))
+        grid = lookup_cells(top, chars, colours)
+        for index, rastercells in cells.items():
+            drawn = top == index
+            grid.composite(CellGrid(rastercells & 0xFF, rastercells >> 8), drawn)
+        return grid
+
+
+def render_view(settings, cols, rows, layers, pan=None):
+    """
+    Render the map grid for a view. This is what the map window hands to the render worker.
+    :param layers: The layers to render, bottom layer first.
+    :param pan: (optional) A (settings, dx, dy) tuple for the view before a pan of dx, dy cells
+    so the grids already drawn for it can be reused.
+    :return: The CellGrid from generate_layers_ascii.
+    """
+    if pan:
+        oldsettings, dx, dy = pan
+        pan_cache(oldsettings, settings.extent(), dx, dy, cols, rows, layers)
+    return generate_layers_ascii(settings, cols, rows, layers)
+
+
+def run_job(job):
+    """
+    Run a render job to completion and return the rendered image.
+
+    When running on the render worker the job is cancelled if a newer render is submitted,
+    in which case RenderCancelled is raised so nothing half drawn gets used. The worker
+    waits on the job in short slices and cancels it itself so the UI thread never blocks
+    on a job and only one thread ever tears it down.
+    """
+    worker = threading.current_thread()
+    if not isinstance(worker, RenderWorker):
+        with metrics.time("render job"):
+            job.start()
+            job.waitForFinished()
+        return job.renderedImage()
+
+    worker.check()
+    with metrics.time("render job"):
+        # The job finishes through signals so run an event loop for it on this thread.
+        loop = QEventLoop()
+        timer = QTimer()
+        timer.setInterval(JOB_POLL_MS)
+        timer.timeout.connect(loop.quit)
+        job.finished.connect(loop.quit)
+        job.start()
+        timer.start()
+        while job.isActive():
+            if worker.superseded():
+                job.cancel()
+                break
+            loop.exec_()
+        timer.stop()
+    worker.check()
+    return job.renderedImage()
+
+
+@timeme
+def render_layer(settings, layer, width, height):
+    settings.setLayers([layer.id()])
+    settings.setFlag(QgsMapSettings.Antialiasing, False)
+    # Layers are only simplified with this on, see simplify_method.
+    settings.setFlag(QgsMapSettings.UseRenderingOptimization, True)
+    settings.setOutputSize(QSize(width, height))
+    image = run_job(QgsMapRendererParallelJob(settings))
+    # image.save(r"/media/nathan/Data/dev/qgis-term/{}.jpg".format(layer.name()))
+    return image
+
+
+def id_color(index):
+    """
+    Return the flat colour the layer at the given index is drawn with in an ID buffer.
+
+    Index 0 is drawn as 1 so black is never confused with an empty pixel.
+    """
+    value = index + 1
+    return QColor((value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF)
+
+
+def flat_renderer(layer, color):
+    """
+    Return a renderer that draws every feature of the layer in a single solid colour.
+    """
+    symbol = QgsSymbolV2.defaultSymbol(layer.geometryType())
+    symbol.setColor(color)
+    for index in range(symbol.symbolLayerCount()):
+        symbollayer = symbol.symbolLayer(index)
+        if hasattr(symbollayer, "setBorderColor"):
+            symbollayer.setBorderColor(color)
+    return QgsSingleSymbolRendererV2(symbol)
+
+
+def id_layer(layer):
+    """
+    Return a copy of the vector layer for drawing into an ID buffer.
+
+    The layers of the project aren't changed off the UI thread so ID renders draw copies
+    opened from the same source. The copies are never added to the layer registry, only
+    the render worker sees them. They are kept until the layer changes.
+    """
+    key = layer_key(layer)
+    held = idlayers.get(layer.id())
+    if held is not None and held[0] == key:
+        return held[1]
+    copy = QgsVectorLayer(layer.source(), layer.name(), layer.providerType())
+    copy.setCrs(layer.crs())
+    copy.setSubsetString(layer.subsetString())
+    copy.setSimplifyMethod(simplify_method())
+    idlayers[layer.id()] = (key, copy)
+    return copy
+
+
+def draw_layers(settings, layers, image):
+    """
+    Draw the layers into the image with their own renderers, bottom layer first.
+    Unlike a render job the layers don't have to be in the layer registry.
+    """
+    painter = QPainter(image)
+    try:
+        for layer in layers:
+            check_cancelled()
+            context = QgsRenderContext.fromMapSettings(settings)
+            context.setPainter(painter)
+            if settings.hasCrsTransformEnabled():
+                context.setCoordinateTransform(QgsCoordinateTransform(layer.crs(), settings.destinationCrs()))
+                context.setExtent(settings.outputExtentToLayerExtent(layer, settings.visibleExtent()))
+            renderer = layer.createMapRenderer(context)
+            renderer.render()
+    finally:
+        painter.end()
+
+
+@timeme
+def render_layer_ids(settings, layers, width, height):
+    """
+    Render all the layers into one image with each layer drawn in its own flat ID colour.
+
+    Copies of the layers are drawn, see id_layer.
+    :param layers: The layers to render, bottom layer first.
+    :return: A (height, width) int array of layer indexes. -1 where no layer was drawn.
+    """
+    registry = QgsMapLayerRegistry.instance()
+    for layerid in list(idlayers):
+        if registry.mapLayer(layerid) is None:
+            del idlayers[layerid]
+
+    copies = []
+    for index, layer in enumerate(layers):
+        copy = id_layer(layer)
+        copy.setRendererV2(flat_renderer(copy, id_color(index)))
+        copies.append(copy)
+
+    settings = QgsMapSettings(settings)
+    # Anything blended or drawn outside the layer symbols would decode to the wrong layer.
+    settings.setFlag(QgsMapSettings.Antialiasing, False)
+    settings.setFlag(QgsMapSettings.DrawLabeling, False)
+    settings.setFlag(QgsMapSettings.UseRenderingOptimization, True)
+    settings.setOutputSize(QSize(width, height))
+    image = QImage(width, height, QImage.Format_ARGB32)
+    # Pixels no layer was drawn in have to decode to no layer whatever the project background is.
+    image.fill(QColor(BACKGROUND).rgb())
+    with metrics.time("render job"):
+        draw_layers(settings, copies, image)
+
+    rgb = image_rgb(image)
+    top = rgb.astype(numpy.int32) - 1
+    top[(rgb == BACKGROUND) | (top >= len(layers))] = -1
+    return top
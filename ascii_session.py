@@ -0,0 +1,83 @@
+"""
+Record the keys of a session so it can be played back later, see benchmarks/replay.py.
+
+A session file is text, one event per line of tab separated fields:
+
+    # ascii_qgis session <cols>x<lines>
+    <ms since recording started>    k    <key code>
+    <ms since recording started>    c    <command line entered>
+    <ms since recording started>    a    <answer to a command's question>
+
+Keys are what gets replayed. Commands and answers are what the keys ended up entering,
+they label the replayed actions and show if a replay went somewhere the session didn't.
+"""
+import time
+import curses
+
+HEADER = "# ascii_qgis session {}x{}\n"
+
+KEY = "k"
+COMMAND = "c"
+ANSWER = "a"
+
+KEY_NAMES = dict((getattr(curses, name), name) for name in dir(curses) if name.startswith("KEY_"))
+KEY_NAMES.update({9: "TAB", 10: "ENTER", 13: "ENTER", 27: "ESC", 32: "SPACE"})
+
+
+def key_name(key):
+    """
+    Return a readable name for a curses key code.
+    """
+    if key in KEY_NAMES:
+        return KEY_NAMES[key]
+    if 32 < key < 127:
+        return chr(key)
+    return str(key)
+
+
+class Recorder(object):
+    """
+    Writes the events of a session to a file as they happen. Each line is flushed so a
+    session that crashes can still be replayed.
+    """
+    def __init__(self, path, cols, lines):
+        self.file = open(path, "w")
+        self.file.write(HEADER.format(cols, lines))
+        self.started = time.time()
+
+    def _write(self, kind, value):
+        ms = int((time.time() - self.started) * 1000.0)
+        self.file.write("{}\t{}\t{}\n".format(ms, kind, value))
+        self.file.flush()
+
+    def key(self, key):
+        self._write(KEY, key)
+
+    def message(self, kind, text):
+        # Tabs and new lines can't be typed into the edit pad, strip them just in case.
+        self._write(kind, text.replace("\t", " ").replace("\n", " "))
+
+    def close(self):
+        self.file.close()
+
+
+def read_session(path):
+    """
+    Read a session file.
+    :return: The (cols, lines) the session was recorded at and a list of (ms, kind, value)
+    events. Key values are ints.
+    """
+    size = None
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("#"):
+                cols, lines = line.split()[-1].split("x")
+                size = (int(cols), int(lines))
+                continue
+            if not line:
+                continue
+            ms, kind, value = line.split("\t", 2)
+            events.append((int(ms), kind, int(value) if kind == KEY else value))
+    return size, events
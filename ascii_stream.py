@@ -0,0 +1,244 @@
+"""
+Encode map frames as the bytes a terminal needs to get from the last frame to the next.
+
+Over a slow SSH link repainting the whole map on every pan is most of the wait. The
+encoder keeps the last frame it sent and only writes the runs of cells that changed. The
+cursor is moved between runs with the shortest escape that gets there, short gaps are
+bridged by writing the unchanged cells again and runs of the same char are sent once with
+REP (repeat the last char) instead of char by char.
+
+usage:
+    stream = FrameStream(open_sink("unix:/tmp/map.sock"), clearfirst=True)
+    stream.send(grid)
+"""
+import os
+import sys
+import socket
+import numpy
+from ascii_metrics import metrics
+
+RESET = "\x1b[0m"
+SAVE_CURSOR = "\x1b7"
+RESTORE_CURSOR = "\x1b8"
+CLEAR_SCREEN = "\x1b[H\x1b[2J"
+
+# The colour pairs below 10 that the map uses, see init_colors in ascii_qgis.
+LOW_PAIRS = {
+    8: "\x1b[37;47m",
+}
+
+
+def sgr(colour):
+    """
+    Return the escape that selects a colour pair. Pair i + 10 has background colour i.
+    """
+    if colour >= 10:
+        return "\x1b[30;48;5;{}m".format(colour - 10)
+    return LOW_PAIRS.get(colour, RESET)
+
+
+def damaged_runs(grid, last=None):
+    """
+    Find the runs of cells that changed between two frames.
+
+    A run is a horizontal stretch of changed cells that share a colour pair so it can be
+    drawn with a single addstr.
+    :param grid: The CellGrid of the new frame.
+    :param last: The CellGrid of the last frame. None to draw every cell.
+    :return: A list of (row, col, endcol, colour) tuples. endcol is exclusive.
+    """
+    rows, cols = numpy.nonzero(grid.changed(last))
+    if not len(rows):
+        return []
+    pairs = grid.colours[rows, cols]
+    starts = numpy.ones(len(rows), dtype=bool)
+    starts[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1] + 1) | (pairs[1:] != pairs[:-1])
+    first = numpy.flatnonzero(starts)
+    last = numpy.append(first[1:], len(rows)) - 1
+    return list(zip(rows[first].tolist(), cols[first].tolist(), (cols[last] + 1).tolist(), pairs[first].tolist()))
+
+
+def _csi(count, code):
+    # A count of 1 is the default and can be left out.
+    return "\x1b[{}{}".format(count if count != 1 else "", code)
+
+
+def cursor_move(fromrow, fromcol, row, col):
+    """
+    Return the shortest escape sequence that moves the cursor to a cell.
+    Rows and cols are 0 based screen positions.
+    :param fromrow: The row the cursor is on. None if it isn't known.
+    """
+    moves = ["\x1b[{};{}H".format(row + 1, col + 1)]
+    if fromrow is not None:
+        down, right = row - fromrow, col - fromcol
+        if not down and not right:
+            return ""
+        if not down:
+            moves.append(_csi(right, "C") if right > 0 else _csi(-right, "D"))
+        elif not right:
+            moves.append(_csi(down, "B") if down > 0 else _csi(-down, "A"))
+        if down > 0 and col == 0:
+            moves.append("\r" + "\n" * down)
+            moves.append(_csi(down, "E"))
+    return min(moves, key=len)
+
+
+def encode_text(codes, rep=True):
+    """
+    Return the chars of a run as text, sending runs of the same char with REP when that is shorter.
+    :param codes: uint8 array of char codes.
+    """
+    if not rep or len(codes) < 4:
+        return codes.tobytes().decode("ascii")
+    starts = numpy.flatnonzero(numpy.diff(codes)) + 1
+    bounds = zip(numpy.append(0, starts).tolist(), numpy.append(starts, len(codes)).tolist())
+    parts = []
+    for start, end in bounds:
+        char = chr(codes[start])
+        repeat = end - start - 1
+        escape = "\x1b[{}b".format(repeat)
+        parts.append(char + escape if len(escape) < repeat else char * (repeat + 1))
+    return "".join(parts)
+
+
+class FrameEncoder(object):
+    """
+    Turns successive frames into the bytes that update a terminal showing the last one.
+    """
+    def __init__(self, top=0, left=0, rep=True):
+        """
+        :param top: Screen row of the first row of the frame.
+        :param left: Screen column of the first column of the frame.
+        :param rep: Use REP for runs of the same char. Most terminals support it, not all.
+        """
+        self.top = top
+        self.left = left
+        self.rep = rep
+        self.frame = None
+
+    def reset(self):
+        """
+        Forget the last frame so the next one is drawn in full. Call this when something
+        else has drawn over the frame.
+        """
+        self.frame = None
+
+    def encode(self, grid):
+        """
+        Return the bytes that draw the CellGrid over the last one encoded.
+        The cursor is left where the last run ended and the colour isn't reset.
+        """
+        chars, colours = grid.chars, grid.colours
+        width = grid.shape[1]
+        parts = []
+        row = col = None
+        colour = None
+        for runrow, runcol, endcol, runcolour in damaged_runs(grid, self.frame):
+            # Writing the unchanged cells of a short gap again is cheaper than moving over them.
+            move = cursor_move(row, col, runrow + self.top, runcol + self.left)
+            start = runcol
+            if row == runrow + self.top and move:
+                gap = runcol + self.left - col
+                gapstart = runcol - gap
+                if 0 < gap <= len(move) and (colours[runrow, gapstart:runcol] == colour).all():
+                    start, move = gapstart, ""
+            parts.append(move)
+            if start != runcol:
+                parts.append(encode_text(chars[runrow, start:runcol], self.rep))
+            if runcolour != colour:
+                parts.append(sgr(runcolour))
+                colour = runcolour
+            parts.append(encode_text(chars[runrow, runcol:endcol], self.rep))
+            row, col = runrow + self.top, endcol + self.left
+            if endcol == width:
+                # The cursor might be waiting to wrap at the edge of the screen.
+                row = col = None
+        self.frame = grid.copy()
+        return "".join(parts).encode("ascii")
+
+
+def _write_all(fd, data):
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def open_sink(target):
+    """
+    Return a function that writes bytes to the target.
+    :param target: "terminal" for this process's terminal, "unix:PATH" for a Unix socket or
+    "HOST:PORT" for a TCP socket. Sockets need something listening, e.g.
+    socat UNIX-LISTEN:/tmp/map.sock STDOUT
+    """
+    if target in ("terminal", "-"):
+        fd = sys.stdout.fileno()
+        return lambda data: _write_all(fd, data)
+    if target.startswith("unix:"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(target[len("unix:"):])
+    else:
+        host, port = target.rsplit(":", 1)
+        sock = socket.create_connection((host, int(port)))
+    return sock.sendall
+
+
+class FrameStream(object):
+    """
+    Sends each frame to a sink as a delta from the last and counts the bytes.
+    """
+    def __init__(self, sink, top=0, left=0, rep=True, keepcursor=False, clearfirst=False):
+        """
+        :param sink: Function the bytes are written to, see open_sink.
+        :param keepcursor: Put the cursor and colour back after each frame. Needed when
+        sharing the terminal with curses.
+        :param clearfirst: Clear the screen before drawing a frame in full.
+        """
+        self.sink = sink
+        self.encoder = FrameEncoder(top, left, rep)
+        self.keepcursor = keepcursor
+        self.clearfirst = clearfirst
+
+    def reset(self):
+        self.encoder.reset()
+
+    def send(self, grid, pan=False):
+        """
+        Send the CellGrid.
+        :param pan: The frame is the result of a pan, its bytes are counted separately
+        along with what a full repaint would have cost.
+        """
+        full = self.encoder.frame is None
+        data = self.encoder.encode(grid)
+        if not data:
+            return 0
+        if self.keepcursor:
+            data = SAVE_CURSOR.encode("ascii") + data + RESTORE_CURSOR.encode("ascii")
+        else:
+            data += RESET.encode("ascii")
+        if full and self.clearfirst:
+            data = CLEAR_SCREEN.encode("ascii") + data
+        self.sink(data)
+
+        metrics.count("stream frames")
+        metrics.count("stream bytes", len(data))
+        if pan:
+            repaint = FrameEncoder(self.encoder.top, self.encoder.left, self.encoder.rep).encode(grid)
+            metrics.count("stream pans")
+            metrics.count("stream pan bytes", len(data))
+            metrics.count("stream pan repaint bytes", len(repaint))
+        return len(data)
+
+
+def pan_report(counters):
+    """
+    Return a line on the bytes sent per pan, or None if there haven't been any.
+    :param counters: The counters from metrics.snapshot().
+    """
+    pans = counters.get("stream pans")
+    if not pans:
+        return None
+    sent = counters.get("stream pan bytes", 0) / float(pans)
+    repaint = counters.get("stream pan repaint bytes", 0) / float(pans)
+    saved = 100.0 * (1 - sent / repaint) if repaint else 0.0
+    return "{:0.0f} bytes per pan, {:0.0f} for a full repaint ({:0.0f}% saved)".format(sent, repaint, saved)
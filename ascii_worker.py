@@ -0,0 +1,166 @@
+"""
+The render worker thread. Renders run on it so the UI never waits on QGIS.
+
+Nothing in here needs QGIS so the thin client, see ascii_client, uses the same worker.
+"""
+import logging
+import threading
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class RenderCancelled(Exception):
+    """
+    Raised inside a render on the render worker when a newer render has been submitted.
+    """
+    pass
+
+
+class RenderWorker(threading.Thread):
+    """
+    Runs renders off the UI thread.
+
+    Only the latest render matters so submitting a new one drops any render still waiting
+    and the render in flight notices it has been superseded and stops, see superseded.
+    Finished renders are put on the results queue.
+    """
+    def __init__(self):
+        super(RenderWorker, self).__init__(name="render")
+        self.daemon = True
+        self.condition = threading.Condition()
+        self.pending = None
+        self.generation = 0
+        self.current = None
+        # A render is running, see idle.
+        self.rendering = False
+        # A render or background task is running, see cancel_all.
+        self.working = False
+        self.results = queue.Queue()
+        # Tasks to run when there is no render to do, see submit_background.
+        self.background = deque()
+        # Called from the worker thread after a result is queued.
+        self.notify = None
+
+    def submit(self, func, *args):
+        """
+        Queue func(*args) to run on the worker.
+        :return: The generation of the render. Results are tagged with it.
+        """
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, func, args)
+            self.condition.notify()
+            return self.generation
+
+    def submit_background(self, func, *args):
+        """
+        Queue func(*args) to run when the worker has no render to do. Background tasks have
+        no results. A task cancelled by a new render is put back and run again afterwards.
+        """
+        with self.condition:
+            self.background.append((func, args))
+            self.condition.notify()
+
+    def clear_background(self):
+        with self.condition:
+            self.background.clear()
+
+    def cancel_all(self):
+        """
+        Drop every render and background task, cancel the one running and wait for it to
+        stop. Call this on the UI thread before freeing anything a render could be using,
+        like the layers of a project being closed.
+        """
+        with self.condition:
+            self.background.clear()
+            self.pending = None
+            self.generation += 1
+            while self.working:
+                self.condition.wait()
+            # A cancelled background task puts itself back.
+            self.background.clear()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.background:
+                    self.condition.wait()
+                if self.pending is None:
+                    task = self.background.popleft()
+                    self.current = self.generation
+                else:
+                    task = None
+                    generation, func, args = self.pending
+                    self.pending = None
+                    self.current = generation
+                    self.rendering = True
+                self.working = True
+            try:
+                if task:
+                    self.run_background(task)
+                else:
+                    self.render(generation, func, args)
+            finally:
+                with self.condition:
+                    self.rendering = False
+                    self.working = False
+                    self.condition.notify_all()
+
+    def render(self, generation, func, args):
+        try:
+            result = func(*args)
+        except RenderCancelled:
+            logging.info("Render {} cancelled".format(generation))
+            return
+        except Exception:
+            logging.exception("Render {} failed".format(generation))
+            result = None
+        self.results.put((generation, result))
+        if self.notify:
+            self.notify()
+
+    def run_background(self, task):
+        func, args = task
+        try:
+            func(*args)
+        except RenderCancelled:
+            with self.condition:
+                self.background.appendleft(task)
+        except Exception:
+            logging.exception("Background task {} failed".format(func.__name__))
+
+    def superseded(self):
+        """
+        Return True if a newer render has been submitted since the running one started.
+        """
+        return self.current != self.generation
+
+    def check(self):
+        """
+        Raise RenderCancelled if the render running has been superseded.
+        """
+        if self.superseded():
+            raise RenderCancelled()
+
+    def latest(self, generation):
+        return generation == self.generation
+
+    def idle(self):
+        """
+        Return True when no render is waiting or running. Background tasks don't count.
+        """
+        with self.condition:
+            return self.pending is None and not self.rendering
+
+
+def check_cancelled():
+    """
+    Raise RenderCancelled if running on the render worker and a newer render has been submitted.
+    """
+    worker = threading.current_thread()
+    if isinstance(worker, RenderWorker):
+        worker.check()
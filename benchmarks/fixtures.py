@@ -0,0 +1,123 @@
+"""
+Synthetic vector datasets and projects for the benchmarks.
+
+Every dataset is made from a fixed random seed so the same size always gives the same
+features. Datasets are only written if they don't already exist as the big ones take a
+while to make.
+"""
+import os
+import random
+from qgis.core import QgsVectorFileWriter, QgsFeature, QgsGeometry, QgsPoint, QgsFields, QgsField, \
+    QgsCoordinateReferenceSystem, QgsProject, QgsMapSettings, QgsRectangle, QGis
+from PyQt4.QtCore import QVariant, QFileInfo
+from PyQt4.QtXml import QDomDocument
+from parfait import load_vector, add_layer
+
+# All features are made inside this extent, in metres.
+EXTENT = (0.0, 0.0, 100000.0, 100000.0)
+CRS = "EPSG:3857"
+
+KINDS = {
+    'point': QGis.WKBPoint,
+    'line': QGis.WKBLineString,
+    'polygon': QGis.WKBPolygon,
+}
+
+
+def _random_point(rand):
+    xmin, ymin, xmax, ymax = EXTENT
+    return QgsPoint(rand.uniform(xmin, xmax), rand.uniform(ymin, ymax))
+
+
+def make_geometry(kind, rand):
+    """
+    Return a random geometry of the given kind inside EXTENT.
+    """
+    start = _random_point(rand)
+    if kind == 'point':
+        return QgsGeometry.fromPoint(start)
+
+    if kind == 'line':
+        points = [start]
+        for _ in range(4):
+            last = points[-1]
+            points.append(QgsPoint(last.x() + rand.uniform(-500, 500), last.y() + rand.uniform(-500, 500)))
+        return QgsGeometry.fromPolyline(points)
+
+    size = rand.uniform(50, 500)
+    x, y = start.x(), start.y()
+    ring = [QgsPoint(x, y), QgsPoint(x + size, y), QgsPoint(x + size, y + size),
+            QgsPoint(x, y + size), QgsPoint(x, y)]
+    return QgsGeometry.fromPolygon([ring])
+
+
+def make_dataset(folder, kind, count):
+    """
+    Write a shapefile of count random features of the given kind.
+    :return: The path to the dataset.
+    """
+    path = os.path.join(folder, "{}_{}.shp".format(kind, count))
+    if os.path.exists(path):
+        return path
+
+    fields = QgsFields()
+    fields.append(QgsField("id", QVariant.Int))
+    crs = QgsCoordinateReferenceSystem(CRS)
+    writer = QgsVectorFileWriter(path, "UTF-8", fields, KINDS[kind], crs, "ESRI Shapefile")
+    rand = random.Random(count)
+    for fid in range(count):
+        feature = QgsFeature(fields)
+        feature.setAttribute("id", fid)
+        feature.setGeometry(make_geometry(kind, rand))
+        writer.addFeature(feature)
+    # Deleting the writer flushes it to disk.
+    del writer
+    return path
+
+
+def make_project(folder, count):
+    """
+    Write a project holding a point, line and polygon dataset with count features each.
+    :return: The path to the project.
+    """
+    path = os.path.join(folder, "synthetic_{}.qgs".format(count))
+    if os.path.exists(path):
+        return path
+
+    project = QgsProject.instance()
+    project.clear()
+    for kind in ('polygon', 'line', 'point'):
+        layer = load_vector(make_dataset(folder, kind, count), name="{} {}".format(kind, count))
+        add_layer(layer)
+    project.write(QFileInfo(path))
+    project.clear()
+    _add_canvas(path)
+    return path
+
+
+def _add_canvas(path):
+    """
+    Add the mapcanvas settings a project only gets when saved from a canvas.
+    """
+    with open(path) as f:
+        doc = QDomDocument()
+        doc.setContent(f.read())
+
+    settings = QgsMapSettings()
+    settings.setExtent(QgsRectangle(*EXTENT))
+    settings.setDestinationCrs(QgsCoordinateReferenceSystem(CRS))
+    canvas = doc.createElement("mapcanvas")
+    settings.writeXML(canvas, doc)
+    doc.documentElement().appendChild(canvas)
+    with open(path, "w") as f:
+        f.write(doc.toString())
+
+
+def make_projects(folder, sizes):
+    """
+    Make the projects for each size.
+    :return: A dict of size to project path.
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return dict((count, make_project(folder, count)) for count in sizes)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+Play a recorded session back through the UI without a terminal and time every action.
+
+Keys are fed to the same EventLoop.dispatch the terminal feeds and the UI draws to the
+fake screen from ascii_headless. An action's latency runs from its key being dispatched to
+the map frame it caused being blitted, or to the key being handled if it didn't draw one.
+
+By default the replay waits for each action to finish before the next key so runs can be
+compared. --speed 1 plays the keys back at the pace they were recorded instead.
+
+usage:
+    python ascii_qgis.py --record session.rec
+    python benchmarks/replay.py session.rec --output replay.json
+    python benchmarks/replay.py session.rec --baseline replay.json
+"""
+import os
+import sys
+import json
+import time
+import select
+import platform
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ascii_qgis
+import ascii_headless
+from ascii_metrics import Metrics
+from ascii_session import read_session, key_name, KEY, COMMAND
+
+DEFAULT_TIMEOUT = 60.0
+
+
+class Capture(object):
+    """
+    Stands in for the session recorder to catch the commands and answers the replay enters.
+    """
+    def __init__(self):
+        self.messages = []
+
+    def key(self, key):
+        pass
+
+    def message(self, kind, text):
+        self.messages.append((kind, text))
+
+
+def pump(loop, until):
+    """
+    Run posted callbacks and timers until the time.
+    """
+    while True:
+        wait = until - time.time()
+        if wait <= 0:
+            return
+        ready, _, _ = select.select([loop.wakeread], [], [], min(wait, 0.01))
+        if ready:
+            loop.run_posted()
+        loop.run_timers()
+
+
+def settle(loop, timeout):
+    """
+    Run the event loop until no render is waiting or running and everything posted has run.
+    :return: False if that didn't happen within timeout seconds.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        ready, _, _ = select.select([loop.wakeread], [], [], 0.001)
+        if ready:
+            loop.run_posted()
+        loop.run_timers()
+        worker = ascii_qgis.renderworker
+        if not ready and loop.posted.empty() and (worker is None or worker.idle()):
+            return True
+    return False
+
+
+def action_label(window, key, entered, lastcommand):
+    """
+    Return the name the latency of a key is reported under.
+    :param entered: The (kind, text) the key entered into the edit pad, if any.
+    """
+    name = type(window).__name__
+    if entered:
+        kind, text = entered
+        if kind == COMMAND:
+            return "{} enter {}".format(name, text)
+        return "{} answer {}".format(name, lastcommand)
+    if 32 < key < 127:
+        return "{} typing".format(name)
+    return "{} {}".format(name, key_name(key))
+
+
+def replay(events, speed, timeout):
+    """
+    Feed the keys of a session to the UI set up by ascii_qgis.start.
+    :return: The metrics of each action, a list of every action and the messages the replay entered.
+    """
+    loop = ascii_qgis.eventloop
+    capture = Capture()
+    loop.recorder = capture
+    mapwindow = ascii_qgis.mapwindow
+    latencies = Metrics()
+    actions = []
+    lastcommand = None
+    pending = None
+
+    def finish(action):
+        label, dispatched, handled, before = action
+        framed = mapwindow.drawn != before
+        ms = ((mapwindow.drawn if framed else handled) - dispatched) * 1000.0
+        latencies.record(label, ms)
+        actions.append({'action': label, 'ms': ms, 'frame': framed})
+
+    settle(loop, timeout)
+    started = time.time()
+    for ms, kind, value in events:
+        if kind != KEY:
+            continue
+        if speed:
+            pump(loop, started + ms / 1000.0 / speed)
+        if pending:
+            finish(pending)
+
+        window = loop.modal or loop.focused
+        entered = len(capture.messages)
+        before = mapwindow.drawn
+        dispatched = time.time()
+        loop.dispatch(value)
+        handled = time.time()
+        entered = capture.messages[entered] if len(capture.messages) > entered else None
+        pending = (action_label(window, value, entered, lastcommand), dispatched, handled, before)
+        if entered and entered[0] == COMMAND:
+            lastcommand = entered[1]
+        if not speed and not settle(loop, timeout):
+            sys.stderr.write("Gave up waiting on {}\n".format(pending[0]))
+
+    settle(loop, timeout)
+    if pending:
+        finish(pending)
+    return latencies, actions, capture.messages
+
+
+def compare(latencies, baseline, threshold):
+    """
+    Return the actions whose median got slower than the baseline by more than threshold.
+    """
+    slower = []
+    for label, summary in sorted(latencies.items()):
+        before = baseline['latencies'].get(label)
+        if before and summary['p50_ms'] > before['p50_ms'] * (1 + threshold):
+            slower.append((label, before['p50_ms'], summary['p50_ms']))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded ascii_qgis session and time each action.")
+    parser.add_argument("session", help="Session file recorded with ascii_qgis.py --record.")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="Play keys back at this multiple of the recorded pace. "
+                             "Defaults to 0, each action finishes before the next key.")
+    parser.add_argument("--size", help="COLSxLINES of the fake terminal. Defaults to the recorded size.")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="Seconds to wait on an action before moving on.")
+    parser.add_argument("--output", default="replay_output.json")
+    parser.add_argument("--baseline", help="Results from an earlier replay to check for regressions against.")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="How much slower, as a fraction, counts as a regression. Defaults to 0.2.")
+    args = parser.parse_args(argv)
+
+    size, events = read_session(args.session)
+    if args.size:
+        cols, lines = args.size.lower().split("x")
+        size = (int(cols), int(lines))
+    cols, lines = size or (200, 50)
+
+    screen = ascii_headless.install(ascii_qgis, lines=lines, cols=cols)
+    ascii_qgis.start(screen)
+    latencies, actions, entered = replay(events, args.speed, args.timeout)
+
+    recorded = [(kind, value) for _, kind, value in events if kind != KEY]
+    diverged = entered != recorded
+    if diverged:
+        sys.stderr.write("The replay entered different commands to the session, timings may not compare\n")
+
+    snapshot = latencies.snapshot()['latencies']
+    output = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'session': os.path.basename(args.session),
+        'size': [cols, lines],
+        'speed': args.speed,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'diverged': diverged,
+        'latencies': snapshot,
+        'actions': actions,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    sys.stdout.write(latencies.report() + "\n")
+    sys.stdout.write("Wrote {} actions to {}\n".format(len(actions), args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = compare(snapshot, baseline, args.threshold)
+        for label, before, after in slower:
+            sys.stdout.write("Slower: {} {:0.1f} ms -> {:0.1f} ms\n".format(label, before, after))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
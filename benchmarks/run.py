@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Time the render pipeline against synthetic projects and write the results as JSON.
+
+No terminal is needed. Map.render_map draws to the fake screen from ascii_headless.
+
+usage:
+    python benchmarks/run.py --sizes 1000,100000 --terminals 80x24,300x100 --output results.json
+    python benchmarks/run.py --baseline last_release.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parfait import projects
+import ascii_render
+import ascii_headless
+from ascii_stream import FrameEncoder, FrameStream
+from benchmarks import fixtures
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_TERMINALS = [(80, 24), (160, 48), (300, 100)]
+
+# Result fields that are measured rather than describing what was measured.
+MEASUREMENTS = ('times_ms', 'min_ms', 'median_ms', 'max_ms', 'addstr_calls', 'bytes_per_pan', 'repaint_bytes')
+
+
+def timed(func, repeat, setup=None):
+    """
+    Call func repeat times and return the milliseconds each call took.
+    :param setup: (optional) Called before each call and not timed.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.time()
+        func()
+        times.append((time.time() - start) * 1000.0)
+    return times
+
+
+def result(name, times, **details):
+    details.update({
+        'name': name,
+        'times_ms': times,
+        'min_ms': min(times),
+        'median_ms': float(numpy.median(times)),
+        'max_ms': max(times),
+    })
+    return details
+
+
+def map_size(terminal):
+    """
+    Return the cols and rows of the map grid on a terminal of the given size.
+    The map window has a one cell border around the grid.
+    """
+    import ascii_qgis
+    cols, lines = terminal
+    return cols - 30 - 2, lines - ascii_qgis.TOPBORDER - 2
+
+
+def bench_stack(terminals, repeat):
+    results = []
+    rand = numpy.random.RandomState(0)
+    for terminal in terminals:
+        cols, rows = map_size(terminal)
+        for count in (1, 10, 30):
+            masks = rand.rand(count, rows, cols) < 0.2
+            chars = [ascii_render.codes[index % 3] for index in range(count)]
+            colours = [11 + index for index in range(count)]
+            times = timed(lambda: ascii_render.stack(masks, chars, colours), repeat)
+            results.append(result("stack", times, terminal=list(terminal), layers=count))
+    return results
+
+
+def bench_project(path, features, terminals, repeat):
+    import ascii_qgis
+    results = []
+    project = projects.open_project(path)
+    ascii_render.watch_layers()
+    ascii_render.assign_layer_colors(256)
+    layers = ascii_render.visible_layers()
+
+    for terminal in terminals:
+        cols, rows = map_size(terminal)
+        size = ascii_render.output_size(cols, rows)
+        details = dict(dataset=os.path.basename(path), features=features, terminal=list(terminal))
+
+        for layer in layers:
+            settings = project.map_settings
+            times = timed(lambda: ascii_render.render_layer(settings, layer, size.width(), size.height()), repeat)
+            results.append(result("render_layer", times, layer=layer.name(), **details))
+
+        settings = project.map_settings
+        times = timed(lambda: ascii_render.generate_layers_ascii(settings, cols, rows, layers), repeat,
+                      setup=ascii_render.rendercache.clear)
+        results.append(result("generate_layers_ascii", times, cache="cold", **details))
+        times = timed(lambda: ascii_render.generate_layers_ascii(settings, cols, rows, layers), repeat)
+        results.append(result("generate_layers_ascii", times, cache="warm", **details))
+
+        screen = ascii_headless.install(ascii_qgis, lines=terminal[1], cols=terminal[0])
+        ascii_qgis.project = project
+        ascii_qgis.modeline = ascii_qgis.ModeLine()
+        mapwindow = ascii_qgis.Map()
+        mapwindow.settings = project.map_settings
+
+        def render_map():
+            mapwindow.render_map()
+            generation, frame = ascii_qgis.renderworker.results.get()
+            mapwindow.draw_grid(frame)
+
+        def cold():
+            ascii_render.rendercache.clear()
+            mapwindow.frame = None
+
+        times = timed(render_map, repeat, setup=cold)
+        results.append(result("Map.render_map", times, cache="cold", **details))
+        calls = screen.addstr_calls_total()
+        times = timed(render_map, repeat)
+        results.append(result("Map.render_map", times, cache="warm",
+                              addstr_calls=screen.addstr_calls_total() - calls, **details))
+
+        # What a pan costs when the map is streamed as delta frames.
+        sent = []
+        mapwindow.stream = FrameStream(lambda data: sent.append(len(data)))
+
+        def pan():
+            mapwindow.pan("right")
+            generation, frame = ascii_qgis.renderworker.results.get()
+            mapwindow.draw_grid(frame, pan=True)
+
+        render_map()
+        del sent[:]
+        times = timed(pan, repeat)
+        repaint = len(FrameEncoder().encode(mapwindow.frame))
+        results.append(result("Map.pan", times, bytes_per_pan=sum(sent) / float(repeat),
+                              repaint_bytes=repaint, **details))
+        mapwindow.stream = None
+
+    project.close()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Return the results whose median got slower than the baseline by more than threshold.
+    """
+    def key(item):
+        return json.dumps(dict((name, value) for name, value in item.items()
+                               if name not in MEASUREMENTS), sort_keys=True)
+
+    old = dict((key(item), item) for item in baseline['results'])
+    slower = []
+    for item in results:
+        before = old.get(key(item))
+        if before and item['median_ms'] > before['median_ms'] * (1 + threshold):
+            slower.append((item, before))
+    return slower
+
+
+def parse_list(value, cast=int):
+    return [cast(part) for part in value.split(",") if part]
+
+
+def parse_terminal(value):
+    cols, lines = value.lower().split("x")
+    return int(cols), int(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ASCII render pipeline.")
+    parser.add_argument("--sizes", type=parse_list, default=DEFAULT_SIZES,
+                        help="Comma separated feature counts. Defaults to 1000,10000,100000,1000000.")
+    parser.add_argument("--terminals", type=lambda value: parse_list(value, parse_terminal), default=DEFAULT_TERMINALS,
+                        help="Comma separated COLSxLINES terminal sizes. Defaults to 80x24,160x48,300x100.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--fixtures", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"),
+                        help="Folder the synthetic datasets and projects are kept in.")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--baseline", help="Results from an earlier run to check for regressions against.")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="How much slower, as a fraction, counts as a regression. Defaults to 0.2.")
+    args = parser.parse_args(argv)
+
+    import ascii_qgis
+    ascii_qgis.init_qgis()
+
+    paths = fixtures.make_projects(args.fixtures, args.sizes)
+    results = bench_stack(args.terminals, args.repeat)
+    for features in args.sizes:
+        results.extend(bench_project(paths[features], features, args.terminals, args.repeat))
+
+    output = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'qgis': ascii_qgis.QGis.QGIS_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    sys.stdout.write("Wrote {} results to {}\n".format(len(results), args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, args.threshold)
+        for item, before in slower:
+            sys.stdout.write("Slower: {} {} {:0.1f} ms -> {:0.1f} ms\n".format(
+                item['name'], item.get('dataset', ''), before['median_ms'], item['median_ms']))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,4 @@
 import sys
-from qgis.core import QgsApplication
 
 
 def init(args=None, guienabled=True, configpath=None, sysexit=True):
@@ -20,6 +19,7 @@ def init(args=None, guienabled=True, configpath=None, sysexit=True):
     configpath - Custom config path QGIS will use to load settings.
     sysexit - Call sys.exit on app exit. True by default.
     """
+    from qgis.core import QgsApplication
     if not args:
         args = []
     if not configpath:
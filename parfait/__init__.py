@@ -1,6 +1,40 @@
-from printing import render_template
-from layer_wrappers import map_layers, load_vector, add_layer
-from projects import open_project
-from qgis.core.contextmanagers import qgisapp
+"""
+The helpers below import their module when first called. Importing parfait on its own
+doesn't pull in the composer or layer registry so scripts can start before QGIS loads.
+"""
 import QGIS
 
+
+def render_template(*args, **kwargs):
+    from printing import render_template
+    return render_template(*args, **kwargs)
+
+
+def map_layers(*args, **kwargs):
+    from layer_wrappers import map_layers
+    return map_layers(*args, **kwargs)
+
+
+def layer_index(*args, **kwargs):
+    from layer_wrappers import layer_index
+    return layer_index(*args, **kwargs)
+
+
+def load_vector(*args, **kwargs):
+    from layer_wrappers import load_vector
+    return load_vector(*args, **kwargs)
+
+
+def add_layer(*args, **kwargs):
+    from layer_wrappers import add_layer
+    return add_layer(*args, **kwargs)
+
+
+def open_project(*args, **kwargs):
+    from projects import open_project
+    return open_project(*args, **kwargs)
+
+
+def qgisapp(*args, **kwargs):
+    from qgis.core.contextmanagers import qgisapp
+    return qgisapp(*args, **kwargs)
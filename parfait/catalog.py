@@ -0,0 +1,254 @@
+"""
+An index of the QGIS projects found under a set of folders.
+
+Walking network shares is slow so the folders are scanned in a background thread and the
+index is saved to disk with the modified time of every folder. When a folder's modified
+time hasn't changed the saved listing is used instead of listing it again.
+
+usage:
+    catalog = Catalog(["/data/projects"], indexpath="project_catalog.json")
+    catalog.start()
+    catalog.matches("roads")
+"""
+import os
+import json
+import logging
+import threading
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def _list_folder(path):
+    """
+    Return the names of the files and sub folders in the folder.
+    :return: A (files, folders) tuple.
+    """
+    files, folders = [], []
+    if scandir:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir():
+                    folders.append(entry.name)
+                else:
+                    files.append(entry.name)
+            except OSError:
+                continue
+        return files, folders
+
+    for name in os.listdir(path):
+        if os.path.isdir(os.path.join(path, name)):
+            folders.append(name)
+        else:
+            files.append(name)
+    return files, folders
+
+
+def fuzzy_score(query, name):
+    """
+    Return how well the query matches the name, lower is better. None if it doesn't match.
+
+    An exact match beats a prefix, a prefix beats a substring and a substring beats the
+    letters of the query showing up in order with gaps between them.
+    """
+    query, name = query.lower(), name.lower()
+    if name == query:
+        return 0
+    if name.startswith(query):
+        return 1
+    if query in name:
+        return 2
+    gaps = 0
+    position = 0
+    for char in query:
+        found = name.find(char, position)
+        if found == -1:
+            return None
+        gaps += found - position
+        position = found + 1
+    return 3 + gaps
+
+
+class Catalog(object):
+    """
+    The projects under a set of folders, kept up to date by a background scan.
+    """
+    def __init__(self, roots, indexpath=None, extension=".qgs"):
+        """
+        :param roots: The folders to look for projects in.
+        :param indexpath: (optional) File the index is saved to and loaded from.
+        :param extension: The file extension of projects.
+        """
+        self.roots = [root for root in roots if root]
+        self.indexpath = indexpath
+        self.extension = extension
+        self.lock = threading.Lock()
+        # Folder path to {'mtime': ..., 'projects': [...], 'folders': [...]}
+        self.folders = {}
+        self.names = {}
+        self.scanned = threading.Event()
+        self.thread = None
+        self.load()
+
+    def load(self):
+        if not self.indexpath or not os.path.exists(self.indexpath):
+            return
+        try:
+            with open(self.indexpath) as f:
+                folders = json.load(f)
+        except (IOError, ValueError):
+            logging.exception("Couldn't load the project catalog {}".format(self.indexpath))
+            return
+        self._update(folders)
+
+    def save(self):
+        if not self.indexpath:
+            return
+        with self.lock:
+            folders = dict(self.folders)
+        try:
+            with open(self.indexpath, "w") as f:
+                json.dump(folders, f)
+        except IOError:
+            logging.exception("Couldn't save the project catalog {}".format(self.indexpath))
+
+    def _update(self, folders):
+        names = {}
+        for folder, entry in folders.items():
+            for project in entry['projects']:
+                names.setdefault(os.path.splitext(project)[0], []).append(os.path.join(folder, project))
+        with self.lock:
+            self.folders = folders
+            self.names = names
+
+    def start(self):
+        """
+        Scan the folders in a background thread, unless a scan is already running.
+        """
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.scan, name="catalog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def scan(self):
+        """
+        Walk the folders and update the index. Folders that haven't changed since the last
+        scan aren't listed again, only their sub folders are checked.
+        """
+        with self.lock:
+            old = dict(self.folders)
+        folders = {}
+        # Real paths of the folders walked. Symlinks can lead back to a folder by another path.
+        seen = set()
+        pending = list(self.roots)
+        while pending:
+            folder = pending.pop()
+            realpath = os.path.realpath(folder)
+            if folder in folders or realpath in seen:
+                continue
+            seen.add(realpath)
+            try:
+                mtime = os.stat(folder).st_mtime
+                entry = old.get(folder)
+                if entry is None or entry['mtime'] != mtime:
+                    files, subfolders = _list_folder(folder)
+                    entry = {
+                        'mtime': mtime,
+                        'projects': sorted(name for name in files if name.lower().endswith(self.extension)),
+                        'folders': sorted(subfolders),
+                    }
+            except OSError:
+                continue
+            folders[folder] = entry
+            pending.extend(os.path.join(folder, name) for name in entry['folders'])
+        self._update(folders)
+        self.save()
+        self.scanned.set()
+        logging.info("Catalog has {} projects in {} folders".format(len(self.projects()), len(folders)))
+
+    def projects(self):
+        """
+        Return the full path of every project in the index.
+        """
+        with self.lock:
+            return [path for paths in self.names.values() for path in paths]
+
+    def _scored(self, query, names=None):
+        """
+        :param names: (optional) The names to score, taken from the catalog if not given.
+        """
+        query = query.strip()
+        if query.lower().endswith(self.extension):
+            query = query[:-len(self.extension)]
+        if names is None:
+            with self.lock:
+                names = self.names
+        scored = []
+        for name in names:
+            score = fuzzy_score(query, name)
+            if score is not None:
+                scored.append((score, len(name), name))
+        scored.sort()
+        return scored
+
+    def matches(self, query, limit=20):
+        """
+        Return the names of the projects that fuzzy match the query, best match first.
+        """
+        return [name for _, _, name in self._scored(query)[:limit]]
+
+    def complete(self, text):
+        """
+        Return what the text completes to, the longest common prefix of the prefix matches
+        or else the best fuzzy match. None if nothing matches.
+        """
+        matches = self.matches(text)
+        if not matches:
+            return None
+        prefixed = [name for name in matches if name.lower().startswith(text.lower())]
+        if prefixed:
+            prefix = os.path.commonprefix(prefixed)
+            if len(prefix) > len(text):
+                return prefix
+            return prefixed[0] if len(prefixed) == 1 else text
+        return matches[0]
+
+    def resolve(self, name):
+        """
+        Return the full path of the project the name refers to. None if there is no project
+        by that name or the name matches more than one project equally well.
+
+        Names can be paths, project names or close enough to a single project name.
+        """
+        name = name.strip()
+        if not name:
+            return None
+        if os.path.isfile(name):
+            return os.path.abspath(name)
+        if name.lower().endswith(self.extension):
+            name = name[:-len(self.extension)]
+
+        # A scan swaps in a new dict of names, work from the one there now throughout.
+        with self.lock:
+            names = self.names
+        paths = names.get(name)
+        if paths:
+            return paths[0]
+
+        scored = self._scored(name, names)
+        if len(scored) == 1 or (scored and scored[0][0] < scored[1][0]):
+            return names[scored[0][2]][0]
+
+        # The scan might not have got to it yet.
+        if not self.scanned.is_set():
+            for root in self.roots:
+                fullpath = os.path.join(root, name + self.extension)
+                if os.path.exists(fullpath):
+                    return fullpath
+        return None
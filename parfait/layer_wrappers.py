@@ -1,27 +1,179 @@
 import os
 import re
+from bisect import bisect_left
 from qgis.core import QgsMapLayerRegistry, QgsVectorLayer
 
-_layerreg = QgsMapLayerRegistry.instance()
+# How many name patterns to remember the matches of.
+MAX_PATTERNS = 1024
+# Chars that make a name pattern a regular expression rather than a plain name prefix.
+PATTERN_CHARS = set(".^$*+?{}[]\\|()")
 
 
-def map_layers(name=None, type=None):
+def _add_to(index, key, layerid):
+    index.setdefault(key, set()).add(layerid)
+
+
+def _remove_from(index, key, layerid):
+    ids = index.get(key)
+    if ids is None:
+        return
+    ids.discard(layerid)
+    if not ids:
+        del index[key]
+
+
+class LayerIndex(object):
     """
-    Return all the loaded layers.  Filters by name (optional) first and then type (optional)
-    :param name: (optional) name of layer to return..
-    :param type: (optional) The QgsMapLayer type of layer to return.
-    :return: List of loaded layers. If name given will return all layers with matching name.
+    The layers in the layer registry indexed by name, type, geometry type and provider.
+
+    The index is kept up to date from the registry's layersAdded and layersRemoved
+    signals and each layer's layerNameChanged signal so lookups don't walk every layer.
     """
-    layers = _layerreg.mapLayers().values()
-    _layers = []
-    if name or type:
+    def __init__(self, registry=None):
+        self.registry = registry or QgsMapLayerRegistry.instance()
+        self.layers = {}
+        # Layer id to the order it was added in so results come back in a stable order.
+        self.order = {}
+        self.added = 0
+        # Layer id to its name and (type, geometry type, provider) as they were indexed.
+        self.names = {}
+        self.keys = {}
+        self.byname = {}
+        self.bytype = {}
+        self.bygeometry = {}
+        self.byprovider = {}
+        # Sorted layer names for prefix lookups. None until the next name lookup after a change.
+        self.sortednames = None
+        # Name pattern to the ids of the layers it matches. Cleared whenever a name changes.
+        self.matches = {}
+        self.registry.layersAdded.connect(self.add_layers)
+        self.registry.layersRemoved.connect(self.remove_layers)
+        self.add_layers(self.registry.mapLayers().values())
+
+    def _keys(self, layer):
+        geometrytype = layer.geometryType() if isinstance(layer, QgsVectorLayer) else None
+        return layer.type(), geometrytype, layer.providerType()
+
+    def _names_changed(self):
+        self.sortednames = None
+        self.matches.clear()
+
+    def add_layers(self, layers):
+        for layer in layers:
+            layerid = layer.id()
+            if layerid in self.layers:
+                continue
+            layertype, geometrytype, provider = self._keys(layer)
+            self.layers[layerid] = layer
+            self.order[layerid] = self.added
+            self.added += 1
+            self.names[layerid] = layer.name()
+            self.keys[layerid] = (layertype, geometrytype, provider)
+            _add_to(self.byname, layer.name(), layerid)
+            _add_to(self.bytype, layertype, layerid)
+            if geometrytype is not None:
+                _add_to(self.bygeometry, geometrytype, layerid)
+            _add_to(self.byprovider, provider, layerid)
+            layer.layerNameChanged.connect(lambda layerid=layerid: self.rename_layer(layerid))
+        self._names_changed()
+
+    def remove_layers(self, layerids):
+        for layerid in layerids:
+            layer = self.layers.pop(layerid, None)
+            if layer is None:
+                continue
+            del self.order[layerid]
+            _remove_from(self.byname, self.names.pop(layerid), layerid)
+            layertype, geometrytype, provider = self.keys.pop(layerid)
+            _remove_from(self.bytype, layertype, layerid)
+            _remove_from(self.bygeometry, geometrytype, layerid)
+            _remove_from(self.byprovider, provider, layerid)
+        self._names_changed()
+
+    def rename_layer(self, layerid):
+        layer = self.layers.get(layerid)
+        if layer is None:
+            return
+        _remove_from(self.byname, self.names[layerid], layerid)
+        self.names[layerid] = layer.name()
+        _add_to(self.byname, layer.name(), layerid)
+        self._names_changed()
+
+    def named(self, pattern):
+        """
+        Return the ids of the layers whose name matches the pattern from the start, like re.match.
+        """
+        ids = self.matches.get(pattern)
+        if ids is not None:
+            return ids
+        if self.sortednames is None:
+            self.sortednames = sorted(self.byname)
+        names = self.sortednames
+        if PATTERN_CHARS.isdisjoint(pattern):
+            # A plain name matches every name starting with it, they sit together in the sorted names.
+            start = bisect_left(names, pattern)
+            end = start
+            while end < len(names) and names[end].startswith(pattern):
+                end += 1
+            found = names[start:end]
+        else:
+            # re keeps its own bounded cache of compiled patterns.
+            regex = re.compile(pattern)
+            found = [name for name in names if regex.match(name)]
+        ids = set()
+        for name in found:
+            ids.update(self.byname[name])
+        if len(self.matches) >= MAX_PATTERNS:
+            self.matches.clear()
+        self.matches[pattern] = ids
+        return ids
+
+    def find(self, name=None, type=None, geometrytype=None, provider=None):
+        """
+        Return the layers that match every filter given, in the order they were added.
+        """
+        filters = []
         if name:
-            _layers = [layer for layer in layers if re.match(name, layer.name())]
-        if type:
-            _layers += [layer for layer in layers if layer.type() == type]
-        return _layers
-    else:
-        return layers
+            filters.append(self.named(name))
+        if type is not None:
+            filters.append(self.bytype.get(type, set()))
+        if geometrytype is not None:
+            filters.append(self.bygeometry.get(geometrytype, set()))
+        if provider is not None:
+            filters.append(self.byprovider.get(provider, set()))
+        if not filters:
+            ids = self.layers
+        else:
+            filters.sort(key=len)
+            ids = set(filters[0])
+            for other in filters[1:]:
+                ids &= other
+        return [self.layers[layerid] for layerid in sorted(ids, key=self.order.__getitem__)]
+
+
+_index = None
+
+
+def layer_index():
+    """
+    Return the LayerIndex of the layer registry, made on first use.
+    """
+    global _index
+    if _index is None:
+        _index = LayerIndex()
+    return _index
+
+
+def map_layers(name=None, type=None, geometrytype=None, provider=None):
+    """
+    Return all the loaded layers. Only layers matching every filter given are returned.
+    :param name: (optional) Pattern the layer name must match from the start, like re.match.
+    :param type: (optional) The QgsMapLayer type of layer to return.
+    :param geometrytype: (optional) The QGis geometry type of vector layers to return.
+    :param provider: (optional) The data provider key of layers to return, e.g. ogr.
+    :return: List of loaded layers.
+    """
+    return layer_index().find(name, type, geometrytype, provider)
 
 
 def add_layer(layer, load_in_legend=True):
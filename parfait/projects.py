@@ -1,4 +1,5 @@
 import os
+from collections import OrderedDict
 from parfait.layer_wrappers import map_layers
 from qgis.core.contextmanagers import qgisapp
 from qgis.core import QgsProject, QgsMapLayerRegistry, QgsMapSettings, QgsComposition
@@ -7,21 +8,81 @@ from PyQt4.QtCore import QFileInfo, QDir
 from PyQt4.QtXml import QDomDocument
 
 
+class ParsedProject(object):
+    """
+    The parsed contents of a project file.
+
+    Parsing a large project is slow so use parsed_project() which hands back the same
+    parsed project until the file changes on disk.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.stamp = _file_stamp(filename)
+        with open(filename) as f:
+            xml = f.read()
+
+        self.doc = QDomDocument()
+        self.doc.setContent(xml)
+        self.canvasnode = self.doc.elementsByTagName("mapcanvas").at(0).toElement()
+        nodes = self.doc.elementsByTagName("Composer")
+        self.composernodes = [nodes.at(nodeid).toElement() for nodeid in range(nodes.count())]
+
+    def is_stale(self):
+        """
+        Return True if the file has changed on disk since it was parsed.
+        """
+        try:
+            return _file_stamp(self.filename) != self.stamp
+        except OSError:
+            return True
+
+    def map_settings(self):
+        """
+        Return a new QgsMapSettings with the canvas settings from the project.
+        """
+        settings = QgsMapSettings()
+        settings.readXML(self.canvasnode)
+        return settings
+
+
+def _file_stamp(filename):
+    stat = os.stat(filename)
+    return stat.st_mtime, stat.st_size
+
+
+# How many parsed projects to keep. Each holds the whole DOM of its project file.
+MAX_PARSED = 4
+
+# Project path to ParsedProject, least recently used first.
+_parsed = OrderedDict()
+
+
+def parsed_project(projectfile):
+    """
+    Return the ParsedProject for the project file, only parsing it again if it has
+    changed on disk since the last call.
+    :param projectfile: The path to the project file.
+    :return: A ParsedProject.
+    """
+    projectfile = os.path.abspath(projectfile)
+    parsed = _parsed.pop(projectfile, None)
+    if parsed is None or parsed.is_stale():
+        parsed = ParsedProject(projectfile)
+    _parsed[projectfile] = parsed
+    while len(_parsed) > MAX_PARSED:
+        _parsed.popitem(last=False)
+    return parsed
+
+
 def composers(projectfile, mapsettings):
-    with open(projectfile) as f:
-        xml = f.read()
-
-    doc = QDomDocument()
-    doc.setContent(xml)
-    nodes = doc.elementsByTagName("Composer")
-    for nodeid in range(nodes.count()):
-        node = nodes.at(0).toElement()
+    parsed = parsed_project(projectfile)
+    doc = parsed.doc
+    for node in parsed.composernodes:
         name = node.attribute("title")
-        compositionnodes = doc.elementsByTagName("Composition")
-        if compositionnodes.count() == 0:
+        compositionelm = node.firstChildElement("Composition")
+        if compositionelm.isNull():
             continue
 
-        compositionelm = compositionnodes.at(0).toElement()
         comp = QgsComposition(mapsettings)
         comp.readXML(compositionelm, doc)
         atlaselm = node.firstChildElement("Atlas")
@@ -31,7 +92,6 @@ def composers(projectfile, mapsettings):
         yield name, comp
 
 
-
 class Project(object):
     """
     A wrapper for handling project based logic.
@@ -64,6 +124,8 @@ class Project(object):
         QgsProject.instance().read(QFileInfo(filename))
         if bridge:
             bridge.setCanvasLayers()
+        # Parse once on load so later lookups are served from the parsed project.
+        parsed_project(filename)
         return cls(bridge)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -78,23 +140,23 @@ class Project(object):
         if self.bridge:
             self.bridge.clear()
 
+    @property
+    def parsed(self):
+        """
+        Return the ParsedProject for the current project file.
+        """
+        return parsed_project(QgsProject.instance().fileName())
+
     @property
     def map_settings(self):
         """
         Return the settings that have been set for the map canvas.
         @return: A QgsMapSettings instance with the settings read from the project.
         """
-        xml = open(QgsProject.instance().fileName()).read()
-        doc = QDomDocument()
-        doc.setContent(xml)
-        canvasnodes = doc.elementsByTagName("mapcanvas")
-        node = canvasnodes.at(0).toElement()
-        settings = QgsMapSettings()
-        settings.readXML(node)
-        return settings
+        return self.parsed.map_settings()
 
     def composers(self):
-        for composer in composers(QgsProject.instance().fileName(), self.map_settings):
+        for composer in composers(self.parsed.filename, self.map_settings):
             yield composer
 
 